@@ -2,7 +2,7 @@
 Data structures for events, examples, and datasets.
 '''
 
-from util import read_json
+from util import iter_json
 from event import Event
 from scenario_db import Scenario
 
@@ -62,13 +62,14 @@ class Dataset(object):
 def read_examples(scenario_db, paths, max_examples):
     '''
     Read a maximum of |max_examples| examples from |paths|.
+    Files are parsed incrementally and reading stops once |max_examples| examples are read.
     '''
     examples = []
     for path in paths:
         print 'read_examples: %s' % path
         if max_examples and len(examples) >= max_examples:
             break
-        for raw in read_json(path):
+        for raw in iter_json(path):
             if max_examples and len(examples) >= max_examples:
                 break
             examples.append(Example.from_dict(scenario_db, raw))
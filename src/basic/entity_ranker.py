@@ -1,8 +1,10 @@
 import argparse
 import collections
+import cPickle as pickle
 import editdistance
 import json
 import numpy as np
+import os
 import re
 import sklearn
 
@@ -11,18 +13,23 @@ from sklearn.feature_extraction import DictVectorizer
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.linear_model import LogisticRegression
 from stop_words import get_stop_words
+from util import fork_map, iter_json
 
 
 class EntityRanker(object):
     """
     Learned ranker for ranking candidates of a span of text for the lexicon
     """
-    def __init__(self, entity_annotations, scenarios, train_data, transcripts_infile):
+    # Version of the saved model format
+    VERSION = 1
+
+    def __init__(self, entity_annotations, scenarios, train_data, transcripts_infile, workers=1):
         """
         :param entity_annotations:  Path to JSON of entity annotations
         :param scenarios: Path to scenarios file for generating training instance and feature vectorizing
         :param train_data: Path to file with train data
         :param transcripts_infile:
+        :param workers: Number of processes used to featurize training data
         :return:
         """
         self._get_uuid_to_kbs(scenarios)
@@ -30,7 +37,7 @@ class EntityRanker(object):
         self.stop_words = set(get_stop_words("en"))
         self._train_tfidf_vectorizer(transcripts_infile)
         inputs, labels = self._process_train_data(train_data)
-        self.classifier = self._train(inputs, labels)
+        self.classifier = self._train(inputs, labels, workers)
 
 
     def _train_tfidf_vectorizer(self, data_infile):
@@ -42,10 +49,7 @@ class EntityRanker(object):
         """
         tfidf_vectorizer = TfidfVectorizer()
         transcripts_text = []
-        with open(data_infile, "r") as f:
-            transcripts = json.load(f)
-
-        for t in transcripts:
+        for t in iter_json(data_infile):
             for e in t["events"]:
                 if e["action"] == "message":
                     if e["data"] is not None:
@@ -68,12 +72,9 @@ class EntityRanker(object):
         Generate uuid to KB mapping for each scenario
         :return:
         """
-        with open(scenarios, "r") as f:
-            scenarios_info = json.load(f)
-
         # Map from uuid to KBs
         uuid_to_kbs = collections.defaultdict(dict)
-        for scenario in scenarios_info:
+        for scenario in iter_json(scenarios):
             uuid = scenario["uuid"]
             agent_kbs = {0: set(), 1: set()}
             for agent_idx, kb in enumerate(scenario["kbs"]):
@@ -84,6 +85,9 @@ class EntityRanker(object):
             uuid_to_kbs[uuid] = agent_kbs
 
         self.uuid_to_kbs = uuid_to_kbs
+        # Map from uuid to agent to entity surface forms (not types) in the agent's KB
+        self.uuid_to_kb_entities = {uuid: {agent: frozenset([e[1] for e in kb]) for agent, kb in agent_kbs.iteritems()}
+                                    for uuid, agent_kbs in uuid_to_kbs.iteritems()}
 
 
     def _feature_func(self, span, entity, agent, uuid):
@@ -95,20 +99,34 @@ class EntityRanker(object):
         :param uuid: uuid of scenario to with available KBs
         :return:
         """
-        entity_clean = re.sub("-", " ", entity)
-        entity_clean_tokens = entity_clean.split()
-        span_tokens = span.split()
+        return self._span_entity_features(span, entity, self._get_kb_entities(agent, uuid))
+
 
-        try:
-            # Set of entities for given agent
-            kb_entities = self.uuid_to_kbs[uuid][agent]
-            # Only consider entity surface form and not type
-            kb_entities = set([e[1] for e in kb_entities])
-        except:
-            kb_entities = None
+    def _get_kb_entities(self, agent, uuid):
+        """
+        Get set of entity surface forms in KB of the given agent
+        :param agent:
+        :param uuid:
+        :return: Set of entities or None if scenario is unknown
+        """
+        kb_entities = self.uuid_to_kb_entities.get(uuid, {}).get(agent)
+        if kb_entities is None:
             print "No entities found for scenario: {0} and agent: {1}".format(uuid, str(agent))
+        return kb_entities
 
 
+    def _span_entity_features(self, span, entity, kb_entities):
+        """
+        Features of _feature_func given the KB entities of the agent
+        :param span:
+        :param entity:
+        :param kb_entities: Set of entities of the agent or None
+        :return:
+        """
+        entity_clean = re.sub("-", " ", entity)
+        entity_clean_tokens = entity_clean.split()
+        span_tokens = span.split()
+
         features = collections.defaultdict(float)
         if span == entity:
             features["EXACT_MATCH"] = 1.0
@@ -162,33 +180,36 @@ class EntityRanker(object):
         return features
 
 
-    def _train_featurize(self, inputs):
+    def _train_featurize_input(self, input):
         """
-        Featurize all inputs and labels for training. Different from testing
-        because we are computing feature vectors as _feature_func(span, gold_entity) - _feature_fun(span, false_entity)
-        :param inputs:
+        Feature vector of one training input: _feature_func(span, e1) - _feature_func(span, e2)
+        :param input:
         :return:
         """
-        feature_vectors = []
-        for input in inputs:
-            span = input["span"]
-            e1 = input["e1"]
-            e2 = input["e2"]
-            agent = input["agent"]
-            uuid = input["uuid"]
-            features_e1 = self._feature_func(span, e1, agent, uuid)
-            features_e2 = self._feature_func(span, e2, agent, uuid)
+        span = input["span"]
+        kb_entities = self._get_kb_entities(input["agent"], input["uuid"])
+        features_e1 = self._span_entity_features(span, input["e1"], kb_entities)
+        features_e2 = self._span_entity_features(span, input["e2"], kb_entities)
+
+        # Calculate diff between features, represented as dict
+        # (Also may want to consider feature concatenation repr.)
+        all_features = features_e1.keys() + features_e2.keys()
+        feature_diff = {}
+        for f in all_features:
+            feature_diff[f] = features_e1[f] - features_e2[f]
 
-            # Calculate diff between features, represented as dict
-            # (Also may want to consider feature concatenation repr.)
-            all_features = features_e1.keys() + features_e2.keys()
-            feature_diff = {}
-            for f in all_features:
-                feature_diff[f] = features_e1[f] - features_e2[f]
+        return feature_diff
 
-            feature_vectors.append(feature_diff)
 
-        return feature_vectors
+    def _train_featurize(self, inputs, workers=1):
+        """
+        Featurize all inputs and labels for training. Different from testing
+        because we are computing feature vectors as _feature_func(span, gold_entity) - _feature_fun(span, false_entity)
+        :param inputs:
+        :param workers: Number of processes (forked, sharing the ranker) to featurize with
+        :return:
+        """
+        return list(fork_map(self._train_featurize_input, inputs, workers, chunksize=500))
 
 
     def _process_train_data(self, train_data):
@@ -207,14 +228,15 @@ class EntityRanker(object):
         return inputs, labels
 
 
-    def _train(self, inputs, labels):
+    def _train(self, inputs, labels, workers=1):
         """
         Train on given inputs and labels
         :param inputs: List Dict of (span, entity1, entity2)
         :param labels: List
+        :param workers: Number of processes used to featurize inputs
         :return:
         """
-        feature_vecs = self._train_featurize(inputs)
+        feature_vecs = self._train_featurize(inputs, workers)
         self.vectorizer = DictVectorizer()
         classifier = LogisticRegression()
 
@@ -227,6 +249,54 @@ class EntityRanker(object):
         return classifier
 
 
+    def save(self, path):
+        """
+        Save the trained ranker: fitted features, classifier weights, tf-idf table and KB index
+        :param path:
+        :return:
+        """
+        model = {"version": self.VERSION,
+                 "feature_names": self.vectorizer.feature_names_,
+                 "classes": self.classifier.classes_,
+                 "coef": self.classifier.coef_,
+                 "intercept": self.classifier.intercept_,
+                 "tfidf_tokens": self.token_to_tfidf.keys(),
+                 "tfidf_weights": np.array(self.token_to_tfidf.values()),
+                 "stop_words": sorted(self.stop_words),
+                 "uuid_to_kb_entities": self.uuid_to_kb_entities,
+                }
+        with open(path, "wb") as fout:
+            pickle.dump(model, fout, pickle.HIGHEST_PROTOCOL)
+
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a ranker saved by save, without the training data
+        :param path:
+        :return:
+        """
+        with open(path, "rb") as fin:
+            model = pickle.load(fin)
+        if model.get("version") != cls.VERSION:
+            raise ValueError("Unsupported entity ranker version {0} in {1}".format(model.get("version"), path))
+
+        ranker = cls.__new__(cls)
+        ranker.stop_words = set(model["stop_words"])
+        ranker.token_to_tfidf = collections.defaultdict(float, zip(model["tfidf_tokens"], model["tfidf_weights"].tolist()))
+        ranker.uuid_to_kb_entities = model["uuid_to_kb_entities"]
+
+        ranker.vectorizer = DictVectorizer()
+        ranker.vectorizer.feature_names_ = model["feature_names"]
+        ranker.vectorizer.vocabulary_ = {f: i for i, f in enumerate(model["feature_names"])}
+
+        ranker.classifier = LogisticRegression()
+        ranker.classifier.classes_ = model["classes"]
+        ranker.classifier.coef_ = model["coef"]
+        ranker.classifier.intercept_ = model["intercept"]
+        return ranker
+
+
     def score(self, span, entity, agent, uuid):
         """
         Score a span and entity once model is trained
@@ -243,6 +313,21 @@ class EntityRanker(object):
         return self.classifier.predict_proba(features_transformed)
 
 
+    def score_batch(self, span, entities, agent, uuid):
+        """
+        Score a span against a list of entities with a single classifier call
+        :param span:
+        :param entities: List of entities
+        :param agent:
+        :param uuid:
+        :return: Array of class probabilities with one row per entity
+        """
+        kb_entities = self._get_kb_entities(agent, uuid)
+        features = [self._span_entity_features(span, entity, kb_entities) for entity in entities]
+        features_transformed = self.vectorizer.transform(features)
+        return self.classifier.predict_proba(features_transformed)
+
+
 if __name__ == "__main__":
     # TODO: Handle keeping terms like "m.d." intact rather than removing punctuation
     re_pattern = r"[(\w*&)]+|[\w]+|\.|\(|\)|\\|\"|\/|;|\#|\$|\%|\@|\{|\}|\:"
@@ -252,12 +337,19 @@ if __name__ == "__main__":
     parser.add_argument("--annotated-examples-path", help="Json of annotated examples", type=str)
     parser.add_argument("--scenarios-json", help="Json of scenario information", type=str)
     parser.add_argument("--transcripts", help="transcripts of data collected")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes used to featurize train data")
+    parser.add_argument("--model-path", help="path to a saved ranker: loaded if it exists, otherwise the trained ranker is saved there")
 
     args = parser.parse_args()
 
     # TODO: Refactor so that can use ranker for ranking different scenarios from
     # TODO: those used for training!
 
-    ranker = EntityRanker(args.annotated_examples_path, args.scenarios_json, args.ranker_data, args.transcripts)
+    if args.model_path and os.path.exists(args.model_path):
+        ranker = EntityRanker.load(args.model_path)
+    else:
+        ranker = EntityRanker(args.annotated_examples_path, args.scenarios_json, args.ranker_data, args.transcripts, args.workers)
+        if args.model_path:
+            ranker.save(args.model_path)
 
     print ranker.score("bible", "bible", 1, "S_cxqu6PM56ACAiDLi").squeeze()
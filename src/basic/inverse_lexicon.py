@@ -1,14 +1,43 @@
 import argparse
+import json
 import numpy as np
+import os
 import time
 
 from lexicon import Lexicon
 from collections import defaultdict, Counter
 from lexicon_utils import get_morphological_variants, get_prefixes, get_edits, get_acronyms
 from schema import Schema
+from util import alias_table, sample_alias_table
 from src.model.vocab import is_entity
 
 
+def read_count_store(path):
+    """
+    Read realization counts persisted by scripts/generate_inverse_lexicon_data.py --counts:
+        {"counts": {entity: {span: count}}, "chat_ids": [ids of counted chats], "watermark": mtime}
+    :param path:
+    :return: The store, empty if path does not exist
+    """
+    if not os.path.exists(path):
+        return {"counts": {}, "chat_ids": [], "watermark": 0}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def write_count_store(store, path):
+    """
+    Write the count store (atomically, so that a realizer loading it never sees a partial file)
+    :param store:
+    :param path:
+    :return:
+    """
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(store, f)
+    os.rename(tmp_path, path)
+
+
 class InverseLexicon(object):
     """
     Inverse lexicon for taking a list of entity tuples and converting to a reasonable surface form
@@ -18,22 +47,60 @@ class InverseLexicon(object):
         self.entities = {}  # Mapping from (canonical) entity to type (assume type is unique)
         self.word_counts = defaultdict(int)  # Counts of words that show up in entities
         self.inverse_lexicon = defaultdict(Counter)  # Mapping from entity -> list of realized variants of entity (seen in data)
+        self.realizations = {}  # Mapping from entity -> (variants, alias table) to sample variants from
+        self.heuristic_realizations = {}  # Cache of realizations of entities not seen in data
         self.load_entities()
         self._process_inverse_lexicon_data(inverse_lexicon_data)
+        self._compile_realizations()
 
     def _process_inverse_lexicon_data(self, inverse_lexicon_data):
         """
         Process inverse lexicon data
             <entity> \t <span> \t <type>
-        and generate variant frequency count
+        and generate variant frequency count. A .json path is read as a count store (see read_count_store).
         :return:
         """
+        if inverse_lexicon_data.endswith(".json"):
+            for entity, span_counts in read_count_store(inverse_lexicon_data)["counts"].iteritems():
+                self.inverse_lexicon[entity].update(span_counts)
+            return
+
         with open(inverse_lexicon_data, "r") as f:
             for line in f:
                 entity, span, type = line.split("\t")
                 self.inverse_lexicon[entity][span] += 1
 
 
+    def update(self, realizations):
+        """
+        Add counts of new (entity, span) realizations and recompile sampling of the affected entities
+        :param realizations: Iterable of (entity, span)
+        :return:
+        """
+        updated = set()
+        for entity, span in realizations:
+            self.inverse_lexicon[entity][span] += 1
+            updated.add(entity)
+        self._compile_realizations(updated)
+
+
+    def _compile_realizations(self, entities=None):
+        """
+        Precompute for each entity an alias table over its variants so that realizing an entity
+        samples a variant in constant time
+        :param entities: Entities to compile (default: all)
+        :return:
+        """
+        if entities is None:
+            entities = self.inverse_lexicon.keys()
+        for entity in entities:
+            counter = self.inverse_lexicon[entity]
+            variants = counter.keys()
+            # Make it peaky
+            peaky_counts = [float(counter[v]) ** 2 for v in variants]
+            self.realizations[entity] = (variants, alias_table(peaky_counts))
+
+
     def load_entities(self):
         for type_, values in self.schema.values.iteritems():
             for value in values:
@@ -65,42 +132,39 @@ class InverseLexicon(object):
         if type == 'item':
             return entity
         # Try checking in inverse lexicon frequency count
-        if entity not in self.inverse_lexicon:
+        if entity in self.realizations:
+            variants, table = self.realizations[entity]
+            return variants[sample_alias_table(table, np.random.random_sample)]
+
+        if entity not in self.heuristic_realizations:
             print "Have not encountered entity %s in data..." % entity
-            realized = -1
-        else:
-            items = self.inverse_lexicon[entity].items()
-            variants = [item[0] for item in items]
-            counts = np.array([item[1] for item in items], dtype=np.float32)
-            # Make it peaky
-            peaky_counts = counts ** 2
-            normal_counts = peaky_counts / np.sum(peaky_counts)
-            try:
-                idx = np.random.choice(np.arange(len(counts)), 1, p=normal_counts)[0]
-            except ValueError:
-                idx = np.argmax(counts)
-            realized = variants[idx]
-
-        if realized != -1:
-            return realized
+            self.heuristic_realizations[entity] = self._realize_unseen_entity(entity)
+        return self.heuristic_realizations[entity]
+
+
+    def _realize_unseen_entity(self, entity):
+        """
+        Heuristic surface form of an entity not found in data
+        :param entity:
+        :return:
+        """
+        # TODO: Modify heuristic rules when entity not found in data
+        if len(entity.split()) == 1:
+            return entity
         else:
-            # TODO: Modify heuristic rules when entity not found in data
-            if len(entity.split()) == 1:
-                return entity
-            else:
-                tokens = entity.split()
-                realized = ""
-                # Only take first two tokens if more than three
-                #if len(tokens) > 3:
-                #    realized = " ".join(tokens[:3])
-                #else:
-                for t in tokens:
-                    if t.lower() == "university":
-                        realized += "univ. "
-                    else:
-                        realized += t + " "
-
-                realized = realized.strip()
+            tokens = entity.split()
+            realized = ""
+            # Only take first two tokens if more than three
+            #if len(tokens) > 3:
+            #    realized = " ".join(tokens[:3])
+            #else:
+            for t in tokens:
+                if t.lower() == "university":
+                    realized += "univ. "
+                else:
+                    realized += t + " "
+
+            realized = realized.strip()
 
         return realized
 
@@ -2,17 +2,112 @@ from collections import defaultdict
 from sample_utils import sorted_candidates
 import csv
 import json
+import numpy as np
 
 
 class KB(object):
     '''
     Represents an agent's knowledge.
+    Items are interned to a matrix of value ids (items x attributes), where column j indexes
+    columns[j], the distinct values of attribute j. Indexes derived from it are built on first use.
     '''
     def __init__(self, attributes, items):
         self.attributes = attributes
         self.items = items
-        self.entity_set = set([value.lower() for item in items for value in item.values()])
         self.entity_type_set = set([attr.value_type for attr in self.attributes])
+        self._matrix = None
+        self._entity_set = None
+        self._entity_key = None
+        self._entity_rows = None
+        self._item_index = None
+
+    def _intern(self):
+        self.value_ids = [{} for attr in self.attributes]  # Value to id in each column
+        self.columns = [[] for attr in self.attributes]  # Id to value in each column
+        matrix = np.empty((len(self.items), len(self.attributes)), dtype=np.int32)
+        for i, item in enumerate(self.items):
+            for j, attr in enumerate(self.attributes):
+                value = item[attr.name]
+                value_id = self.value_ids[j].get(value)
+                if value_id is None:
+                    value_id = self.value_ids[j][value] = len(self.columns[j])
+                    self.columns[j].append(value)
+                matrix[i, j] = value_id
+        # Entity (lowercased value, type) of each value id
+        self.column_entities = [[(value.lower(), attr.value_type) for value in column]
+                                for attr, column in zip(self.attributes, self.columns)]
+        self._matrix = matrix
+
+    @property
+    def matrix(self):
+        if self._matrix is None:
+            self._intern()
+        return self._matrix
+
+    def entity(self, i, j):
+        '''
+        Return the entity of item i for attribute j.
+        '''
+        value_id = self.matrix[i, j]
+        return self.column_entities[j][value_id]
+
+    @property
+    def entity_set(self):
+        if self._entity_set is None:
+            self.matrix
+            self._entity_set = set([entity for column in self.column_entities for entity, type_ in column])
+        return self._entity_set
+
+    @property
+    def entity_key(self):
+        '''
+        Hashable key of entity_set and entity_type_set (e.g. to memoize entity linking).
+        '''
+        if self._entity_key is None:
+            self._entity_key = (frozenset(self.entity_set), frozenset(self.entity_type_set))
+        return self._entity_key
+
+    @property
+    def entity_rows(self):
+        '''
+        Map from entity to the rows it appears in (once per attribute).
+        '''
+        if self._entity_rows is None:
+            entity_rows = defaultdict(list)
+            matrix = self.matrix
+            for i in xrange(matrix.shape[0]):
+                for j, value_id in enumerate(matrix[i]):
+                    entity_rows[self.column_entities[j][value_id]].append(i)
+            self._entity_rows = dict(entity_rows)
+        return self._entity_rows
+
+    def item_id(self, item):
+        '''
+        Return the index of the first item equal to |item|, or None.
+        '''
+        if self._item_index is None:
+            self._item_index = {}
+            for i, row in enumerate(self.matrix.tolist()):
+                self._item_index.setdefault(tuple(row), i)
+        if len(item) != len(self.attributes):
+            return None
+        key = []
+        for value_ids, attr in zip(self.value_ids, self.attributes):
+            value_id = value_ids.get(item.get(attr.name))
+            if value_id is None:
+                return None
+            key.append(value_id)
+        return self._item_index.get(tuple(key))
+
+    def match(self, other):
+        '''
+        Return (i, j) for the first item i of this KB that is item j of |other|, or None.
+        '''
+        for i, item in enumerate(self.items):
+            j = other.item_id(item)
+            if j is not None:
+                return (i, j)
+        return None
 
     @staticmethod
     def from_dict(attributes, raw):
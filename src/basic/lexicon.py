@@ -3,34 +3,81 @@ import editdistance
 import json
 import re
 import random
+import numpy as np
 
+from array import array
 from collections import defaultdict
+from functools import partial
 from fuzzywuzzy import fuzz
-from lexicon_utils import get_prefixes, get_acronyms, get_edits, get_morphological_variants
+from lexicon_utils import get_prefixes, get_acronyms, get_morphological_variants, EditIndex
+from lexicon_snapshot import snapshot_key, write_snapshot, read_snapshot
+from util import LRUCache, fork_map, iter_json
 
 def add_lexicon_arguments(parser):
     parser.add_argument('--stop-words', type=str, default='data/common_words.txt', help='Path to stop words list')
     parser.add_argument('--learned-lex', default=False, action='store_true', help='if true have entity linking in lexicon use learned system')
     parser.add_argument('--inverse-lexicon', help='Path to inverse lexicon data')
+    parser.add_argument('--lexicon-cache', help='Path to lexicon snapshot; built and saved if missing or stale')
+    parser.add_argument('--link-cache-size', type=int, default=0, help='Number of entity linking results to memoize (0 to disable)')
+    parser.add_argument('--link-workers', type=int, default=1, help='Number of processes used to link whole corpora')
 
 class BaseLexicon(object):
     """
     Base lexicon class defining general purpose functions for any lexicon
     """
-    def __init__(self, schema, learned_lex, stop_words=None):
+    def __init__(self, schema, learned_lex, stop_words=None, cache=None):
         self.schema = schema
         # if True, lexicon uses learned system
         self.learned_lex = learned_lex
         self.entities = {}  # Mapping from (canonical) entity to type (assume type is unique)
         self.word_counts = defaultdict(int)  # Counts of words that show up in entities
-        self.lexicon = defaultdict(list)  # Mapping from string -> list of (entity, type)
+        # Entities are interned to integer ids; phrases map to sorted arrays of ids
+        self.entity_list = []  # Mapping from id -> (entity, type)
+        self.entity_ids = {}  # Mapping from entity -> id
+        self.lexicon = defaultdict(partial(array, 'i'))  # Mapping from string -> array of entity ids
+        self.edit_index = EditIndex()  # Edit distance 1 variants of entity tokens -> array of entity ids
         with open(stop_words, 'r') as fin:
             self.stop_words = set([x.strip() for x in fin.read().split()][:1000])
             self.stop_words.update(['one', '1', 'two', '2', 'three', '3', 'four', '4', 'five', '5', 'six', '6', 'seven', '7', 'eight', '8', 'nine', '9', 'ten', '10'])
+        if cache is not None and self.load(cache):
+            print 'Loaded lexicon from %s: %d phrases mapping to %d entities, %d fuzzy tokens' % (cache, len(self.lexicon), len(self.entities), len(self.edit_index))
+        else:
+            self.build(cache)
+        self.type_masks = self._get_type_masks()
+        self.clean_entities = {entity: self._clean_entity(entity) for entity, type_ in self.entity_list}
+
+    def build(self, cache=None):
         self.load_entities()
         self.compute_synonyms()
-        print 'Created lexicon: %d phrases mapping to %d entities, %f entities per phrase' % (len(self.lexicon), len(self.entities), sum([len(x) for x in self.lexicon.values()])/float(len(self.lexicon)))
+        print 'Created lexicon: %d phrases mapping to %d entities, %f entities per phrase, %d fuzzy tokens' % (len(self.lexicon), len(self.entities), sum([len(x) for x in self.lexicon.values()])/float(len(self.lexicon)), len(self.edit_index))
+        if cache is not None:
+            self.save(cache)
+
+    def save(self, path):
+        '''
+        Write a snapshot of the built lexicon that can be memory-mapped by load().
+        '''
+        write_snapshot(path, snapshot_key(self.schema, self.stop_words), self)
 
+    def load(self, path):
+        '''
+        Load the lexicon from a snapshot written by save(). Tables are memory-mapped so that
+        processes loading the same file share its pages.
+        Return False if the snapshot does not exist or was built from a different schema or stop words.
+        '''
+        snapshot = read_snapshot(path, snapshot_key(self.schema, self.stop_words))
+        if snapshot is None:
+            return False
+        header, self.lexicon, (deletes, anagrams, values) = snapshot
+        self.entities = {}
+        for entity, type_ in header['entities']:
+            self.entities[entity] = type_
+            self._intern(entity, type_)
+        self.word_counts = defaultdict(int, header['word_counts'])
+        self.edit_index.deletes = deletes
+        self.edit_index.anagrams = anagrams
+        self.edit_index.values = values
+        return True
 
     def load_entities(self):
         for type_, values in self.schema.values.iteritems():
@@ -44,8 +91,71 @@ class BaseLexicon(object):
                 self.word_counts[word] += 1
         self.entities[entity] = type
 
+    def _intern(self, entity, type):
+        if entity not in self.entity_ids:
+            self.entity_ids[entity] = len(self.entity_list)
+            self.entity_list.append((entity, type))
+        return self.entity_ids[entity]
+
+    def _get_type_masks(self):
+        '''
+        Return a dict of {type: bitmask of ids of entities of that type}.
+        '''
+        type_masks = defaultdict(int)
+        for i, (entity, type_) in enumerate(self.entity_list):
+            type_masks[type_] |= 1 << i
+        return type_masks
+
+    def _clean_entity(self, entity):
+        entity = re.sub("-", " ", entity)
+        return entity, tuple(entity.split())
+
+    def get_clean_entity(self, entity):
+        '''
+        Return the entity with punctuation removed and its tokens.
+        '''
+        try:
+            return self.clean_entities[entity]
+        except KeyError:
+            return self._clean_entity(entity)
+
+    def entity_mask(self, ids):
+        mask = 0
+        for i in ids:
+            mask |= 1 << i
+        return mask
+
+    def mask_to_ids(self, mask):
+        '''
+        Return ids in the bitmask in increasing order.
+        '''
+        ids = []
+        while mask:
+            low = mask & -mask
+            ids.append(low.bit_length() - 1)
+            mask ^= low
+        return ids
+
+    def _is_filtered(self, phrase):
+        return self.stop_words and phrase not in self.word_counts and phrase in self.stop_words
+
+    def lookup_ids(self, phrase):
+        '''
+        Return sorted ids of entities matching phrase.
+        '''
+        results = self.lexicon.get(phrase, ())
+        if self._is_filtered(phrase):
+            return results
+        edit_results = self.edit_index.lookup(phrase)
+        if not edit_results:
+            return results
+        # Merge with exact matches
+        results = set(results)
+        results.update(edit_results)
+        return sorted(results)
+
     def lookup(self, phrase):
-        return self.lexicon.get(phrase, [])
+        return [self.entity_list[i] for i in self.lookup_ids(phrase)]
 
 
 
@@ -53,13 +163,17 @@ class Lexicon(BaseLexicon):
     """
     Lexicon that only computes per token entity transforms rather than per phrase transforms (except for prefixes/acronyms)
     """
-    def __init__(self, schema, learned_lex=False, entity_ranker=None, scenarios_json=None, stop_words=None):
-        super(Lexicon, self).__init__(schema, learned_lex, stop_words)
+    def __init__(self, schema, learned_lex=False, entity_ranker=None, scenarios_json=None, stop_words=None, cache=None, link_cache_size=0):
+        super(Lexicon, self).__init__(schema, learned_lex, stop_words, cache)
+        # Memoize linking of frequent utterances (shared by all sessions using this lexicon)
+        self.link_cache = LRUCache(link_cache_size) if link_cache_size > 0 else None
         # TODO: Remove hard-coding (use list of common words/phrases/stop words)
         self.common_phrases = set(["went", "to", "and", "of", "my", "the", "names", "any",
                                    "friends", "at", "for", "in", "many", "partner", "all", "we",
                                    "start", "go", "school", "do", "know", "no", "work", "are",
                                    "he", "she"])
+        # Tokens ignored when intersecting candidates of a span
+        self.span_stop_words = set(['of'])
 
         # Ensure an entity ranker is provided for scoring (span, entity) pairs
         if learned_lex:
@@ -76,13 +190,10 @@ class Lexicon(BaseLexicon):
         :param scenarios_json: Path to scenarios json file
         :return:
         """
-        with open(scenarios_json, "r") as f:
-            scenarios_info = json.load(f)
-
         # Map from uuid to KBs
         uuid_to_kbs_with_types = collections.defaultdict(dict)
         uuid_to_kbs = collections.defaultdict(dict)
-        for scenario in scenarios_info:
+        for scenario in iter_json(scenarios_json):
             uuid = scenario["uuid"]
             # Keep track of separate mappings to entities with types and entities without types
             agent_kbs = {0: set(), 1: set()}
@@ -111,6 +222,7 @@ class Lexicon(BaseLexicon):
         """
         # Keep track of tokens we have seen to handle repeats
         for entity, type in self.entities.items():
+            entity_id = self._intern(entity, type)
             phrases = []
             mod_entity = entity
             for s in [' of ', ' - ', '-']:
@@ -128,7 +240,8 @@ class Lexicon(BaseLexicon):
             for phrase in phrases:
                 synonyms.append(phrase)
                 if type != 'person':
-                    synonyms.extend(get_edits(phrase))
+                    # Edit distance 1 variants are matched by the edit index at lookup time
+                    self.edit_index.add(phrase, entity_id)
                     synonyms.extend(get_morphological_variants(phrase))
                     synonyms.extend(get_prefixes(phrase, min_length=1))
                 if phrase in ('and', '&', "'n"):
@@ -144,9 +257,22 @@ class Lexicon(BaseLexicon):
 
             # Add to lexicon
             for synonym in set(synonyms):
-                if self.stop_words and synonym not in self.word_counts and synonym in self.stop_words:
+                if self._is_filtered(synonym):
                     continue
-                self.lexicon[synonym].append((entity, type))
+                self.lexicon[synonym].append(entity_id)
+
+    def _is_stopwords(self, span, span_tokens):
+        """
+        Return True if the span should not be linked unless it matches the entity exactly.
+        """
+        if len(span_tokens) == 1 and span in self.stop_words:
+            return True
+        if span_tokens and span_tokens[0] in ('and', 'or', 'to', 'from', 'of', 'in', 'at'):
+            return True
+        for x in span_tokens:
+            if x not in self.stop_words:
+                return False
+        return True
 
     def score_and_match(self, span, candidates, agent, uuid, kb_entities, kb_entity_types, known_kb=True):
         """
@@ -161,44 +287,34 @@ class Lexicon(BaseLexicon):
         # Use heuristic scoring system
         #print 'span:', span
         if not self.learned_lex:
-            entity_scores = []
+            # Common phrases are never linked
+            if span in self.common_phrases:
+                return (span, None)
+
+            # Span features shared by all candidates
+            span_tokens = span.split()
+            span_is_stopwords = self._is_stopwords(span, span_tokens)
+
+            best_entity = None
+            num_scores = 0
             for c in candidates:
                 #print 'c:', c
-                # Clean up punctuation
-                c_s = re.sub("-", " ", c[0])
-                span_tokens = span.split()
-                entity_tokens = c_s.split()
-
-                ed = editdistance.eval(span, c[0])
+                entity, type_ = c
                 # Filter false positives
-                if c[1] not in kb_entity_types:
+                if type_ not in kb_entity_types:
                     #print 'false type'
                     continue
-
-                def is_stopwords():
-                    if span == c[0]:
-                        return False
-                    if len(span_tokens) == 1 and span in self.stop_words:
-                        return True
-                    if span_tokens[0] in ('and', 'or', 'to', 'from', 'of', 'in', 'at'):
-                        return True
-                    all_stop = True
-                    for x in span_tokens:
-                        if x not in self.stop_words:
-                            all_stop = False
-                            break
-                    if all_stop:
-                        return True
-                    return False
-
-                if is_stopwords():
+                if span_is_stopwords and span != entity:
                     #print 'stop words'
                     continue
+
+                # Clean up punctuation
+                c_s, entity_tokens = self.get_clean_entity(entity)
                 if len(span_tokens) > len(entity_tokens):
                     continue
-                if c[0] not in kb_entities and known_kb:
+                if entity not in kb_entities and known_kb:
                     # Prioritize exact match
-                    if c[0] == span:
+                    if entity == span:
                         score = 0
                     else:
                         #print 'not in kb'
@@ -209,47 +325,45 @@ class Lexicon(BaseLexicon):
                 elif len(span_tokens) > 1 and span in c_s:
                     score = 1
                 else:
-                    score = ed + 2
+                    score = editdistance.eval(span, entity) + 2
                 # Prioritize entity in KB even if we are not sure
-                if not known_kb and c[0] not in kb_entities and c[0] != span:
+                if not known_kb and entity not in kb_entities and entity != span:
                     score += 3
                 #print 'score:', score
 
-                entity_scores.append(c + (score,))
+                num_scores += 1
+                # Keep the first best scoring candidate
+                if best_entity is None or score < best_entity[2]:
+                    best_entity = (entity, type_, score)
 
-            # Sort entity scores
-            if len(entity_scores) == 0:
+            if best_entity is None:
                 return (span, None)
-            entity_scores = sorted(entity_scores, key=lambda x: x[2])
 
             # If exact match or substring match with an entity
-            entity, type_, score = entity_scores[0]
+            entity, type_, score = best_entity
 
             # Be more cautious when not known_kb; +3 because previous prioritization
             if score > 8 and not known_kb:
                 best_match = (span, None)
-            elif (score > 5 and len(entity_scores) > 1) or span in self.common_phrases:
+            elif score > 5 and num_scores > 1:
                 best_match = (span, None)
             else:
                 best_match = (entity, type_)
         else:
-            # Use learned ranker
-            entity_scores = []
-            for c in candidates:
-                score = self.entity_ranker.score(span, c[0], agent, uuid).squeeze()
-                entity_scores.append(c + (score[0] - score[1],))
+            # Use learned ranker: score all candidates and the span itself in one batch
+            probs = self.entity_ranker.score_batch(span, [c[0] for c in candidates] + [span], agent, uuid)
+            scores = probs[:, 0] - probs[:, 1]
 
             # Where does original span fit into all this? If smaller than some threshold
-            span_score = self.entity_ranker.score(span, span, agent, uuid).squeeze()
+            span_score = scores[-1]
 
-            # Sort entity scores
-            entity_scores = sorted(entity_scores, key=lambda x: x[2])
-            best_entity = entity_scores[0][:3]
+            # First candidate with the lowest score
+            best = int(np.argmin(scores[:-1]))
 
-            if (span_score[0] - span_score[1]) < best_entity[2]:
+            if span_score < scores[best]:
                 best_match = (span, None)
             else:
-                best_match = best_entity[:2]
+                best_match = candidates[best]
 
         return best_match
 
@@ -279,6 +393,44 @@ class Lexicon(BaseLexicon):
         combined_entity_tokens.extend(cache)
         return combined_entity_tokens
 
+    def _span_candidates(self, raw_tokens, token_ids, token_masks, start, max_length=6):
+        """
+        Return candidate entities (as a bitmask of entity ids) of spans starting at start, where the
+        i-th element corresponds to the span of length i+1. Candidates of a span are the intersection
+        of the candidates of its tokens (ignoring 'of' except as the first token), so they are computed
+        incrementally from the shorter span and we stop at the first span without candidates: longer
+        spans can't have any.
+        """
+        span_candidates = []
+        end = min(start + max_length, len(raw_tokens))
+        candidates = -1
+        for j in xrange(start, end):
+            if j == start or raw_tokens[j] not in self.span_stop_words:
+                if token_masks[j] is None:
+                    token_masks[j] = self.entity_mask(token_ids[j])
+                candidates &= token_masks[j]
+            span_candidates.append(candidates)
+            if candidates == 0:
+                break
+        return span_candidates
+
+    def _ordered_candidates(self, raw_tokens, token_ids, token_sets, start, length, candidates):
+        """
+        Return entities of the bitmask candidates of the span raw_tokens[start:start+length] as a list
+        of (entity, type). score_and_match sorts scores stably, so this order breaks ties: it is the
+        order of intersecting the candidate sets of the tokens of the span one by one.
+        """
+        if not candidates & (candidates - 1):
+            # Single candidate
+            return [self.entity_list[candidates.bit_length() - 1]]
+        entities = [self.entity_list[x] for x in token_ids[start]]
+        for j in xrange(start, start + length):
+            if raw_tokens[j] not in self.span_stop_words:
+                if token_sets[j] is None:
+                    token_sets[j] = set([self.entity_list[x] for x in token_ids[j]])
+                entities = list(set(entities).intersection(token_sets[j]))
+        return [e for e in entities if (candidates >> self.entity_ids[e[0]]) & 1]
+
     def link_entity(self, raw_tokens, return_entities=False, agent=1, uuid="NONE", kb=None, mentioned_entities=None, known_kb=True):
         """
         Add detected entities to each token
@@ -290,6 +442,29 @@ class Lexicon(BaseLexicon):
         :param agent: Agent (0,1) whose utterance is being linked
         :param uuid: uuid of scenario being used for testing whether candidate entity is in KB
         """
+        # NOTE: don't memoize random linking when no KB is provided
+        if self.link_cache is not None and kb is not None:
+            key = (tuple(raw_tokens), kb.entity_key, frozenset(mentioned_entities or ()), known_kb,
+                   (agent, uuid) if self.learned_lex else None)
+            result = self.link_cache.get(key)
+            if result is None:
+                result = self._link_entity(raw_tokens, agent, uuid, kb, mentioned_entities, known_kb)
+                self.link_cache.put(key, result)
+        else:
+            result = self._link_entity(raw_tokens, agent, uuid, kb, mentioned_entities, known_kb)
+        # Copy so that callers can't modify cached results
+        linked, found_entities = list(result[0]), list(result[1])
+
+        # For computing per dialogue entities found
+        if return_entities:
+            return linked, found_entities
+
+        return linked
+
+    def _link_entity(self, raw_tokens, agent, uuid, kb, mentioned_entities, known_kb):
+        """
+        Return linked tokens and found entities (see link_entity).
+        """
         if kb is not None:
             kb_entities = kb.entity_set
             if mentioned_entities is not None:
@@ -299,31 +474,38 @@ class Lexicon(BaseLexicon):
             kb_entities = None
             kb_entity_types = None
 
+        # Candidates whose type is not in the KB are filtered by the heuristic scorer
+        type_mask = -1
+        if kb_entity_types is not None and not self.learned_lex:
+            type_mask = 0
+            for type_ in kb_entity_types:
+                type_mask |= self.type_masks.get(type_, 0)
+
+        # Look up each token once; spans are scored from the prefix intersections below
+        token_ids = [self.lookup_ids(token) for token in raw_tokens]
+        token_masks = [None] * len(raw_tokens)
+        token_sets = [None] * len(raw_tokens)
+
         i = 0
         found_entities = []
         linked = []
-        stop_words = set(['of'])
         while i < len(raw_tokens):
-            candidate_entities = None
-            single_char = False
+            matched = False
             # Find longest phrase (if any) that matches an entity
-            for l in range(6, 0, -1):
+            span_candidates = self._span_candidates(raw_tokens, token_ids, token_masks, i)
+            for l in xrange(len(span_candidates), 0, -1):
                 phrase = ' '.join(raw_tokens[i:i+l])
-                raw = raw_tokens[i:i+l]
-
-                for idx, token in enumerate(raw):
-                    results = self.lookup(token)
-                    if idx == 0: candidate_entities = results
-                    if token not in stop_words:
-                        candidate_entities = list(set(candidate_entities).intersection(set(results)))
+                candidates = span_candidates[l-1] & type_mask
 
                 # Single character token so disregard candidate entities
-                if l == 1 and len(phrase) == 1:
-                    single_char = True
+                # NOTE: the last token is not disregarded, as it is also matched by spans
+                # that run past the end of the utterance
+                if l == 1 and len(phrase) == 1 and i + 1 < len(raw_tokens):
                     break
 
                 # Found some match
-                if len(candidate_entities) > 0:
+                if candidates:
+                    candidate_entities = self._ordered_candidates(raw_tokens, token_ids, token_sets, i, l, candidates)
                     if kb_entities is not None:
                         best_match = self.score_and_match(phrase, candidate_entities, agent, uuid, kb_entities, kb_entity_types, known_kb)
                     else:
@@ -335,23 +517,51 @@ class Lexicon(BaseLexicon):
                         linked.append((phrase, best_match))
                         found_entities.append((phrase, best_match))
                         i += l
+                        matched = True
                         break
-                    else:
-                        candidate_entities = None
-                        continue
 
-            if not candidate_entities or single_char:
+            if not matched:
                 linked.append(raw_tokens[i])
                 i += 1
 
         linked = self.combine_repeated_entity(linked)
-
-        # For computing per dialogue entities found
-        if return_entities:
-            return linked, found_entities
-
-        return linked
-
+        return linked, found_entities
+
+
+    def _link_example(self, args):
+        ex, tokenize, agent = args
+        kbs = ex.scenario.kbs
+        mentioned_entities = set()
+        linked_events = []
+        for e in ex.events:
+            if agent is not None and e.agent != agent:
+                linked_events.append(None)
+                continue
+            if e.action == 'select':
+                # Values of the selected item are mentioned (see Preprocessor.item_to_entities)
+                mentioned_entities.update(e.data[attr.name].lower() for attr in kbs[e.agent].attributes)
+            if e.action != 'message':
+                linked_events.append(None)
+                continue
+            entity_tokens = self.link_entity(tokenize(e.data), kb=kbs[e.agent], mentioned_entities=mentioned_entities)
+            for token in entity_tokens:
+                if not isinstance(token, basestring):
+                    mentioned_entities.add(token[1][0])
+            linked_events.append(entity_tokens)
+        return linked_events
+
+    def link_corpus(self, examples, workers=1, tokenize=None, agent=None, chunksize=10):
+        """
+        Link messages of all examples, sharded over |workers| forked processes which share this
+        lexicon (see fork_map). Examples are streamed to the workers and results are yielded in order.
+        For each example, yield a list with the linked tokens of each event (None for non-message
+        events). Entities mentioned (or selected) earlier in the dialogue are considered as in the KB.
+        :param tokenize: Function from a message to a list of tokens (default: preprocess.tokenize)
+        :param agent: If not None, only link messages of this agent (and track their mentions)
+        """
+        if tokenize is None:
+            from src.model.preprocess import tokenize
+        return fork_map(self._link_example, ((ex, tokenize, agent) for ex in examples), workers, chunksize)
 
     def test(self):
         sentence3 = "I went to University of Pensylvania and most my friends are from there".split(" ")
@@ -367,6 +577,7 @@ class Lexicon(BaseLexicon):
 if __name__ == "__main__":
     from schema import Schema
     import argparse
+    import os
     import time
     from entity_ranker import EntityRanker
 
@@ -376,13 +587,19 @@ if __name__ == "__main__":
     parser.add_argument("--annotated-examples-path", help="Json of annotated examples", type=str)
     parser.add_argument("--scenarios-json", help="Json of scenario information", type=str)
     parser.add_argument("--transcripts", help="Json file of all transcripts collected")
+    parser.add_argument("--model-path", help="path to a saved ranker: loaded if it exists, otherwise the trained ranker is saved there")
 
     args = parser.parse_args()
 
     path = args.schema
     start_build = time.time()
 
-    ranker = EntityRanker(args.annotated_examples_path, args.scenarios_json, args.ranker_data, args.transcripts)
+    if args.model_path and os.path.exists(args.model_path):
+        ranker = EntityRanker.load(args.model_path)
+    else:
+        ranker = EntityRanker(args.annotated_examples_path, args.scenarios_json, args.ranker_data, args.transcripts)
+        if args.model_path:
+            ranker.save(args.model_path)
     schema = Schema(path)
     lex = Lexicon(schema, learned_lex=True, entity_ranker=ranker, scenarios_json=args.scenarios_json)
     print "Building complete: ", time.time() - start_build
@@ -0,0 +1,181 @@
+'''
+Compact on-disk format for a built lexicon that can be memory-mapped and shared read-only
+between processes.
+
+Layout:
+    MAGIC | header length (uint32) | JSON header | table | table | ...
+Each table maps sorted (utf-8) strings to lists of integers:
+    size (uint32) | key offsets (uint32 * size+1) | posting offsets (uint32 * size+1) | keys | postings (int32)
+'''
+
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import numpy as np
+from array import array
+
+MAGIC = 'COCOALEX'
+VERSION = 1
+
+def _encode(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+def snapshot_key(schema, stop_words):
+    '''
+    Hash of everything the lexicon is built from, used to invalidate stale snapshots.
+    '''
+    h = hashlib.sha1()
+    h.update(str(VERSION))
+    h.update(json.dumps(schema.values, sort_keys=True))
+    h.update(json.dumps(sorted(stop_words or [])))
+    return h.hexdigest()
+
+def _read_offsets(buf, offset, count):
+    '''
+    Offsets are copied into a compact array (4 bytes each): indexing numpy views of the buffer
+    is too slow for the binary search, and the string and posting blobs are the bulk of a table.
+    '''
+    offsets = array('I')
+    offsets.fromstring(buf[offset:offset+4*count])
+    if sys.byteorder == 'big':
+        offsets.byteswap()
+    return offsets
+
+def write_table(fout, mapping):
+    '''
+    Write a mapping from string to a list of ints.
+    '''
+    keys = sorted(mapping.iterkeys(), key=_encode)
+    encoded = [_encode(k) for k in keys]
+    key_offsets = np.zeros(len(keys) + 1, dtype='<u4')
+    key_offsets[1:] = np.cumsum([len(k) for k in encoded])
+    postings = [mapping[k] for k in keys]
+    posting_offsets = np.zeros(len(keys) + 1, dtype='<u4')
+    posting_offsets[1:] = np.cumsum([len(p) for p in postings])
+    fout.write(struct.pack('<I', len(keys)))
+    fout.write(key_offsets.tostring())
+    fout.write(posting_offsets.tostring())
+    fout.write(''.join(encoded))
+    fout.write(np.array([x for p in postings for x in p], dtype='<i4').tostring())
+
+class TableKeys(object):
+    '''
+    Sorted keys of a PhraseTable as a sequence (supports bisect).
+    '''
+    def __init__(self, table):
+        self.table = table
+
+    def __len__(self):
+        return self.table.size
+
+    def __getitem__(self, i):
+        table = self.table
+        return table.buf[table.keys_start + table.key_offsets[i]:table.keys_start + table.key_offsets[i+1]]
+
+class PhraseTable(object):
+    '''
+    Read-only mapping from string to a list of values backed by a (memory-mapped) buffer.
+    values: list to decode integer postings; postings are returned as is if None.
+    '''
+    def __init__(self, buf, offset, values=None):
+        self.buf = buf
+        self.values = values
+        self.size, = struct.unpack_from('<I', buf, offset)
+        offset += 4
+        self.key_offsets = _read_offsets(buf, offset, self.size+1)
+        offset += 4 * (self.size + 1)
+        self.posting_offsets = _read_offsets(buf, offset, self.size+1)
+        offset += 4 * (self.size + 1)
+        self.keys_start = offset
+        offset += self.key_offsets[-1]
+        self.postings = np.frombuffer(buf, dtype='<i4', count=self.posting_offsets[-1], offset=offset)
+        self.end = offset + 4 * self.posting_offsets[-1]
+        self.sorted_keys = TableKeys(self)
+
+    def __len__(self):
+        return self.size
+
+    def find(self, key):
+        key = _encode(key)
+        i = bisect.bisect_left(self.sorted_keys, key)
+        if i < self.size and self.sorted_keys[i] == key:
+            return i
+        return -1
+
+    def posting(self, i):
+        ids = self.postings[self.posting_offsets[i]:self.posting_offsets[i+1]].tolist()
+        if self.values is None:
+            return ids
+        return [self.values[x] for x in ids]
+
+    def __contains__(self, key):
+        return self.find(key) >= 0
+
+    def __getitem__(self, key):
+        i = self.find(key)
+        if i < 0:
+            raise KeyError(key)
+        return self.posting(i)
+
+    def get(self, key, default=None):
+        i = self.find(key)
+        if i < 0:
+            return default
+        return self.posting(i)
+
+    def iteritems(self):
+        for i in xrange(self.size):
+            yield self.sorted_keys[i], self.posting(i)
+
+def write_snapshot(path, key, lexicon):
+    '''
+    Write the lexicon tables to path (atomically, so that concurrent readers never see a partial file).
+    '''
+    index = lexicon.edit_index
+    tokens = sorted(index.values.iterkeys(), key=_encode)
+    token_ids = {token: i for i, token in enumerate(tokens)}
+    header = {'key': key,
+              'entities': lexicon.entity_list,
+              'word_counts': lexicon.word_counts,
+             }
+    header = json.dumps(header)
+
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as fout:
+        fout.write(MAGIC)
+        fout.write(struct.pack('<I', len(header)))
+        fout.write(header)
+        write_table(fout, lexicon.lexicon)
+        write_table(fout, index.values)
+        write_table(fout, {k: [token_ids[t] for t in v] for k, v in index.deletes.iteritems()})
+        write_table(fout, {k: [token_ids[t] for t in v] for k, v in index.anagrams.iteritems()})
+    os.rename(tmp_path, path)
+
+def read_snapshot(path, key):
+    '''
+    Return (header, lexicon table, edit index tables) or None if the snapshot is missing or stale.
+    '''
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as fin:
+        buf = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    if buf[:len(MAGIC)] != MAGIC:
+        return None
+    offset = len(MAGIC)
+    header_len, = struct.unpack_from('<I', buf, offset)
+    offset += 4
+    header = json.loads(buf[offset:offset+header_len])
+    if header['key'] != key:
+        return None
+    offset += header_len
+    lexicon = PhraseTable(buf, offset)
+    values = PhraseTable(buf, lexicon.end)
+    deletes = PhraseTable(buf, values.end, values.sorted_keys)
+    anagrams = PhraseTable(buf, deletes.end, values.sorted_keys)
+    return header, lexicon, (deletes, anagrams, values)
@@ -1,3 +1,8 @@
+from array import array
+from collections import defaultdict
+from functools import partial
+
+
 def get_prefixes(entity, min_length=3, max_length=8):
     # computer science => ['comp sci', ...]
     words = entity.split()
@@ -92,3 +97,85 @@ def get_morphological_variants(entity):
             results.append(base + 'er')
             results.append(base + 'ers')
     return results
+
+
+class EditIndex(object):
+    """
+    Symmetric-delete index returning the tokens that get_edits(token) would have produced a
+    variant equal to the query, without materializing the variants.
+    Each token is stored under itself and its single-character deletions (insert, delete,
+    substitute and adjacent transposition all meet on one of these keys) and under its sorted
+    characters (arbitrary transpositions preserve the multiset of characters).
+    """
+    def __init__(self):
+        self.deletes = defaultdict(set)  # Mapping from token or single deletion -> set of tokens
+        self.anagrams = defaultdict(set)  # Mapping from sorted characters -> set of tokens
+        self.values = defaultdict(partial(array, 'i'))  # Mapping from token -> array of (integer) values
+
+    def __len__(self):
+        return len(self.values)
+
+    @classmethod
+    def _deletes(cls, word):
+        return [word[:i] + word[i+1:] for i in xrange(len(word))]
+
+    def add(self, token, value):
+        # Same length cutoff as get_edits
+        if len(token) < 3:
+            return
+        if token not in self.values:
+            self.deletes[token].add(token)
+            for key in self._deletes(token):
+                self.deletes[key].add(token)
+            self.anagrams[''.join(sorted(token))].add(token)
+        if value not in self.values[token]:
+            self.values[token].append(value)
+
+    def match(self, phrase):
+        """
+        Return tokens with phrase in get_edits(token).
+        """
+        candidates = set()
+        for key in [phrase] + self._deletes(phrase):
+            candidates.update(self.deletes.get(key, ()))
+        candidates.update(self.anagrams.get(''.join(sorted(phrase)), ()))
+        return [token for token in candidates if is_edit(token, phrase)]
+
+    def lookup(self, phrase):
+        results = []
+        for token in self.match(phrase):
+            results.extend(self.values[token])
+        return results
+
+
+def is_edit(entity, word):
+    """
+    Return True if word is in get_edits(entity), i.e. one insertion, deletion or substitution
+    (using characters from alphabet) or a transposition of two (not necessarily adjacent) letters.
+    """
+    if len(entity) < 3 or word == entity:
+        return False
+    n, m = len(entity), len(word)
+    if m == n + 1:
+        # Insert
+        for i in xrange(m):
+            if word[:i] + word[i+1:] == entity:
+                return word[i] in alphabet
+        return False
+    if m == n - 1:
+        # Delete
+        for i in xrange(n):
+            if entity[:i] + entity[i+1:] == word:
+                return True
+        return False
+    if m != n:
+        return False
+    diffs = [i for i in xrange(n) if entity[i] != word[i]]
+    if len(diffs) == 1:
+        # Substitute
+        return word[diffs[0]] in alphabet
+    if len(diffs) == 2:
+        # Transposition
+        i, j = diffs
+        return entity[i] == word[j] and entity[j] == word[i]
+    return False
@@ -1,6 +1,10 @@
 from kb import KB
+import json
+import mmap
+import re
 import numpy as np
 from schema import Attribute
+from util import LRUCache, iter_json_spans
 
 def add_scenario_arguments(parser):
     parser.add_argument('--schema-path', help='Input path that describes the schema of the domain', required=True)
@@ -16,6 +20,15 @@ class Scenario(object):
         self.attributes = attributes
         self.kbs = kbs
         self.alphas = alphas
+        self._matched_items = None
+
+    def get_matched_items(self):
+        '''
+        Return ids of the first item shared by the two KBs (computed once), or None.
+        '''
+        if self._matched_items is None:
+            self._matched_items = self.kbs[0].match(self.kbs[1])
+        return self._matched_items
 
     @staticmethod
     def from_dict(schema, raw):
@@ -52,6 +65,7 @@ class ScenarioDB(object):
         self.selected_scenarios = set()
         for scenario in scenarios_list:
             self.scenarios_map[scenario.uuid] = scenario
+        self.uuids = [scenario.uuid for scenario in scenarios_list]
 
     def get(self, uuid):
         return self.scenarios_map[uuid]
@@ -74,3 +88,92 @@ class ScenarioDB(object):
 
     def to_dict(self):
         return [s.to_dict() for s in self.scenarios_list]
+
+
+class ScenarioSequence(object):
+    '''
+    Read-only list of the scenarios of a LazyScenarioDB, materialized on access.
+    '''
+    def __init__(self, scenario_db):
+        self.scenario_db = scenario_db
+
+    def __len__(self):
+        return len(self.scenario_db.uuids)
+
+    def __getitem__(self, i):
+        return self.scenario_db.get(self.scenario_db.uuids[i])
+
+    def __iter__(self):
+        for uuid in self.scenario_db.uuids:
+            yield self.scenario_db.get(uuid)
+
+
+class LazyScenarioDB(ScenarioDB):
+    '''
+    ScenarioDB backed by a scenarios file (JSON list or JSON Lines). Only the byte range of each
+    scenario is indexed; a scenario is parsed when it is first requested and kept in an LRU cache
+    of |cache_size| scenarios.
+    '''
+    uuid_pattern = re.compile(r'"uuid":\s*"([^"]*)"')
+
+    def __init__(self, schema, path, cache_size=1000):
+        self.schema = schema
+        self.path = path
+        self.spans = {}  # Map from uuid to byte range in the file
+        self.uuids = []
+        for start, end, uuid in self._index(path):
+            self.spans[uuid] = (start, end)
+            self.uuids.append(uuid)
+        self.size = len(self.uuids)
+        self.selected_scenarios = set()
+        self.cache = LRUCache(cache_size)
+        self.scenarios_list = ScenarioSequence(self)
+        with open(path, 'rb') as fin:
+            self.buf = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @classmethod
+    def _index(cls, path):
+        '''
+        Yield (start, end, uuid) of each scenario in the file.
+        '''
+        with open(path, 'rb') as fin:
+            json_lines = fin.read(1024).lstrip()[:1] == '{'
+        if not json_lines:
+            for start, end, raw in iter_json_spans(path):
+                yield start, end, raw['uuid']
+            return
+
+        # Lines are not parsed: the first uuid of a scenario is its own (KBs have no uuid)
+        with open(path, 'rb') as fin:
+            offset = 0
+            for line in fin:
+                start = offset
+                offset += len(line)
+                if not line.strip():
+                    continue
+                match = cls.uuid_pattern.search(line)
+                uuid = json.loads('"%s"' % match.group(1)) if match else json.loads(line)['uuid']
+                yield start, offset, uuid
+
+    def get(self, uuid):
+        scenario = self.cache.get(uuid)
+        if scenario is None:
+            start, end = self.spans[uuid]
+            scenario = Scenario.from_dict(self.schema, json.loads(self.buf[start:end]))
+            self.cache.put(uuid, scenario)
+        return scenario
+
+    def select_random(self, exclude_seen=True):
+        scenarios = set(self.uuids)
+
+        if exclude_seen:
+            scenarios = scenarios - self.selected_scenarios
+            if len(scenarios) == 0:
+                scenarios = set(self.uuids)
+                self.selected_scenarios = set()
+        uuid = np.random.choice(list(scenarios))
+
+        return self.get(uuid)
+
+    def to_dict(self):
+        return [json.loads(self.buf[start:end]) for start, end in (self.spans[uuid] for uuid in self.uuids)]
@@ -52,12 +52,8 @@ class SimpleSession(Session):
         '''
         Return a dict of {entity: [row]}
         '''
-        entity_coords = defaultdict(list)
-        for row, item in enumerate(self.kb.items):
-            for col, attr in enumerate(self.kb.attributes):
-                entity = (item[attr.name].lower(), attr.value_type)
-                entity_coords[entity].append(row)
-        return entity_coords
+        # Copy the rows: the KB's index is shared by its lookups
+        return defaultdict(list, ((e, list(rows)) for e, rows in self.kb.entity_rows.iteritems()))
 
     def get_related_entity(self, entities):
         '''
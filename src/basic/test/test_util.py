@@ -0,0 +1,14 @@
+import json
+from basic.util import iter_json, iter_json_spans
+
+class TestUtil(object):
+    def test_iter_json_chunks(self, tmpdir):
+        path = str(tmpdir.join('list.json'))
+        with open(path, 'w') as fout:
+            fout.write('[1.5, 2, -3e-2 , {"a": [1, 2.25], "b": "x,]"}, 10 ,\n 0.125e+3]\n')
+        expected = json.load(open(path))
+        raw = open(path).read()
+        for chunk_size in xrange(1, len(raw) + 1):
+            assert list(iter_json(path, chunk_size)) == expected
+            for start, end, obj in iter_json_spans(path, chunk_size):
+                assert json.loads(raw[start:end]) == obj
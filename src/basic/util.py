@@ -1,7 +1,14 @@
 import random
+import re
 import json
 import string
+import threading
 import cPickle as pickle
+import multiprocessing
+import sys
+from Queue import Queue
+from collections import OrderedDict
+from itertools import imap
 
 def random_multinomial(probs):
     target = random.random()
@@ -13,15 +20,110 @@ def random_multinomial(probs):
             return i
         i += 1
 
-def generate_uuid(prefix):
-    return prefix + '_' + ''.join([random.choice(string.digits + string.letters) for _ in range(16)])
+def alias_table(weights):
+    '''
+    Build Walker's alias table for sampling index i with probability proportional to weights[i].
+    Return (prob, alias): bucket i keeps i with probability prob[i], otherwise it is alias[i].
+    '''
+    n = len(weights)
+    total = float(sum(weights))
+    scaled = [w * n / total for w in weights]
+    prob = [1.] * n
+    alias = range(n)
+    small = [i for i, p in enumerate(scaled) if p < 1.]
+    large = [i for i, p in enumerate(scaled) if p >= 1.]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] -= 1. - scaled[s]
+        if scaled[l] < 1.:
+            small.append(l)
+        else:
+            large.append(l)
+    return prob, alias
+
+def sample_alias_table(table, rand=random.random):
+    '''
+    Sample an index from an alias table in O(1) using a single uniform draw from rand().
+    '''
+    prob, alias = table
+    u = rand() * len(prob)
+    i = int(u)
+    return i if u - i < prob[i] else alias[i]
+
+def generate_uuid(prefix, rng=random):
+    return prefix + '_' + ''.join([rng.choice(string.digits + string.letters) for _ in range(16)])
 
 def read_json(path):
     try:
+        if path.endswith('.jsonl'):
+            return list(iter_json(path))
         return json.load(open(path))
     except:
         raise Exception('Error reading JSON from %s' % path)
 
+_json_separator = re.compile(r'[\s,]*')
+_json_whitespace = re.compile(r'\s*')
+
+def iter_json(path, chunk_size=1<<20):
+    '''
+    Iterate over the objects in a JSON Lines file or in a JSON file containing a list.
+    Objects are parsed incrementally, so the whole file is never loaded in memory.
+    '''
+    for _, _, obj in iter_json_spans(path, chunk_size):
+        yield obj
+
+def iter_json_spans(path, chunk_size=1<<20):
+    '''
+    Same as iter_json but yield (start, end, obj) where [start, end) is the byte range of obj in the file.
+    '''
+    decoder = json.JSONDecoder()
+    with open(path) as fin:
+        base = 0  # Offset of buf in the file
+        buf = fin.read(chunk_size)
+        while buf.isspace():
+            base += len(buf)
+            buf = fin.read(chunk_size)
+        pos = _json_separator.match(buf).end()
+        if buf[pos:pos+1] != '[':
+            # JSON Lines
+            fin.seek(0)
+            offset = 0
+            for line in fin:
+                start = offset
+                offset += len(line)
+                if line.strip():
+                    yield start, offset, json.loads(line)
+            return
+
+        pos += 1
+        eof = False
+        while True:
+            pos = _json_separator.match(buf, pos).end()
+            if pos < len(buf):
+                if buf[pos] == ']':
+                    return
+                try:
+                    obj, end = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    end = None
+                # An object is complete once followed by ',' or ']': before that it may be
+                # truncated at the end of the buffer (e.g. '1.' of '1.5')
+                if end is not None:
+                    next_pos = _json_whitespace.match(buf, end).end()
+                    if eof or buf[next_pos:next_pos+1] in (',', ']'):
+                        yield base + pos, base + end, obj
+                        pos = end
+                        continue
+            if eof:
+                raise ValueError('Invalid JSON list in %s' % path)
+            chunk = fin.read(chunk_size)
+            eof = not chunk
+            base += pos
+            buf = buf[pos:] + chunk
+            pos = 0
+
 def write_json(raw, path):
     with open(path, 'w') as out:
         print >>out, json.dumps(raw)
@@ -33,3 +135,110 @@ def read_pickle(path):
 def write_pickle(obj, path):
     with open(path, 'wb') as fout:
         pickle.dump(obj, fout)
+
+class LRUCache(object):
+    '''
+    Bounded mapping that evicts the least recently used entry; safe to share between threads.
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.cache)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.cache.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # Move to the most recent position
+            self.cache[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.cache.pop(key, None)
+            self.cache[key] = value
+            while len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.cache),
+                'hit_rate': self.hits / float(total) if total else 0.}
+
+# Function run by fork_map workers; inherited when the pool is forked so it is never pickled
+_fork_func = None
+
+def _call_fork_func(item):
+    return _fork_func(item)
+
+def fork_map(func, iterable, workers=1, chunksize=1):
+    '''
+    Yield func(item) for each item of iterable, in order, using |workers| forked processes.
+    Workers share the parent's memory (e.g. a built lexicon) copy-on-write: only the items and
+    the results are pickled. Runs in the current process if workers <= 1.
+    '''
+    global _fork_func
+    if workers <= 1:
+        for result in imap(func, iterable):
+            yield result
+        return
+    _fork_func = func
+    try:
+        pool = multiprocessing.Pool(workers)
+    finally:
+        _fork_func = None
+    try:
+        for result in pool.imap(_call_fork_func, iterable, chunksize):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def prefetch(iterable, size):
+    '''
+    Yield items of iterable, computed ahead by a background thread that keeps at most |size|
+    items in a queue. This overlaps Python work in the iterable with code that releases the
+    GIL while consuming items (e.g. a TensorFlow session). Exceptions are re-raised in order.
+    '''
+    queue = Queue(maxsize=size)
+    stop = threading.Event()
+    end = object()
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                queue.put((item, None))
+        except:
+            queue.put((None, sys.exc_info()))
+        else:
+            queue.put((end, None))
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, exc_info = queue.get()
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if item is end:
+                return
+            yield item
+    finally:
+        # The consumer may stop early (e.g. on an infinite batch generator): unblock the producer
+        stop.set()
+        while not queue.empty():
+            queue.get()
+        thread.join()
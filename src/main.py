@@ -8,7 +8,7 @@ import os
 import time
 import tensorflow as tf
 from itertools import chain
-from src.basic.util import read_json, write_json, read_pickle, write_pickle
+from src.basic.util import read_json, write_json, read_pickle, write_pickle, iter_json
 from src.basic.dataset import add_dataset_arguments, read_dataset
 from src.basic.schema import Schema
 from src.basic.scenario_db import ScenarioDB, add_scenario_arguments
@@ -76,11 +76,11 @@ if __name__ == '__main__':
         ckpt = None
 
     schema = Schema(model_args.schema_path, model_args.domain)
-    scenario_db = ScenarioDB.from_dict(schema, read_json(args.scenarios_path))
+    scenario_db = ScenarioDB.from_dict(schema, iter_json(args.scenarios_path))
     dataset = read_dataset(scenario_db, args)
     print 'Building lexicon...'
     start = time.time()
-    lexicon = Lexicon(schema, args.learned_lex, stop_words=args.stop_words)
+    lexicon = Lexicon(schema, args.learned_lex, stop_words=args.stop_words, cache=args.lexicon_cache, link_cache_size=args.link_cache_size)
     print '%.2f s'% (time.time() - start)
 
     # Dataset
@@ -91,11 +91,13 @@ if __name__ == '__main__':
     preprocessor = Preprocessor(schema, lexicon, model_args.entity_encoding_form, model_args.entity_decoding_form, model_args.entity_target_form)
     if args.test:
         model_args.dropout = 0
-        data_generator = DataGenerator(None, None, dataset.test_examples, preprocessor, schema, model_args.num_items, mappings, use_kb, copy)
+        data_generator = DataGenerator(None, None, dataset.test_examples, preprocessor, schema, model_args.num_items, mappings, use_kb, copy, cache=args.data_cache, batch_cache_size=args.batch_cache_size, max_batch_tokens=args.max_batch_tokens, workers=args.preprocess_workers)
     else:
-        data_generator = DataGenerator(dataset.train_examples, dataset.test_examples, None, preprocessor, schema, model_args.num_items, mappings, use_kb, copy)
+        data_generator = DataGenerator(dataset.train_examples, dataset.test_examples, None, preprocessor, schema, model_args.num_items, mappings, use_kb, copy, cache=args.data_cache, batch_cache_size=args.batch_cache_size, max_batch_tokens=args.max_batch_tokens, workers=args.preprocess_workers)
     for d, n in data_generator.num_examples.iteritems():
         logstats.add('data', d, 'num_dialogues', n)
+    if lexicon.link_cache is not None:
+        logstats.add('lexicon', 'link_cache', lexicon.link_cache.stats())
 
     # Save mappings
     if not mappings:
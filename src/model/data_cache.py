@@ -0,0 +1,114 @@
+'''
+Versioned on-disk cache of preprocessed dialogues (see DataGenerator), stored column-wise in .npy
+files that later runs memory-map instead of linking the corpus again.
+
+An entry is a directory <cache_dir>/<key> where key hashes the examples and the preprocessing setup:
+    meta.pkl: version and symbol table (tokens and entities of all utterances)
+    examples.npy: index of the example of each dialogue (num_dialogues)
+    matched_items.npy: (num_dialogues, 2)
+    dialogue_offsets.npy: utterances of each dialogue (num_dialogues + 1)
+    agents.npy: agent of each utterance (num_utterances)
+    <stage>_offsets.npy: tokens of each utterance (num_utterances + 1)
+    <stage>_tokens.npy: symbol ids of the tokens of all utterances
+where stage is encoding or decoding.
+'''
+
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+from src.basic.util import read_pickle, write_pickle
+from src.basic.lexicon_snapshot import snapshot_key
+
+VERSION = 2
+STAGES = ('encoding', 'decoding')
+
+def cache_key(examples, preprocessor):
+    '''
+    Hash of the examples and everything they are preprocessed with.
+    NOTE: a retrained entity ranker (--learned-lex) is not part of the key.
+    '''
+    lexicon = preprocessor.lexicon
+    h = hashlib.sha1()
+    h.update(str(VERSION))
+    h.update(snapshot_key(lexicon.schema, lexicon.stop_words))
+    h.update(str(lexicon.learned_lex))
+    h.update(json.dumps(preprocessor.entity_forms, sort_keys=True))
+    # NOTE: no sort_keys, which would disable the C encoder
+    scenarios = set()
+    for ex in examples:
+        h.update(json.dumps([ex.ex_id, ex.uuid, [e.to_dict() for e in ex.events], ex.outcome]))
+        if ex.scenario.uuid not in scenarios:
+            scenarios.add(ex.scenario.uuid)
+            h.update(json.dumps(ex.scenario.to_dict()))
+    return h.hexdigest()
+
+def _column_path(path, name):
+    return os.path.join(path, '%s.npy' % name)
+
+def write_dialogues(path, dialogues, example_ids):
+    '''
+    Write token turns of preprocessed dialogues (before convert_to_int) to the directory path.
+    example_ids: index of the example each dialogue is created from.
+    The directory is renamed in place once complete, so readers never see a partial entry.
+    '''
+    symbol_ids = {}
+    symbols = []
+    def symbol_id(token):
+        if token not in symbol_ids:
+            symbol_ids[token] = len(symbols)
+            symbols.append(token)
+        return symbol_ids[token]
+
+    agents = []
+    dialogue_offsets = [0]
+    offsets = {stage: [0] for stage in STAGES}
+    tokens = {stage: [] for stage in STAGES}
+    for dialogue in dialogues:
+        for agent, enc_turn, dec_turn in zip(dialogue.agents, *dialogue.token_turns):
+            for utterances in zip(enc_turn, dec_turn):
+                agents.append(agent)
+                for stage, utterance in zip(STAGES, utterances):
+                    tokens[stage].extend(symbol_id(token) for token in utterance)
+                    offsets[stage].append(len(tokens[stage]))
+        dialogue_offsets.append(len(agents))
+
+    columns = {'examples': np.array(example_ids, dtype=np.int32),
+               'matched_items': np.array([d.matched_items for d in dialogues], dtype=np.int32).reshape(-1, 2),
+               'dialogue_offsets': np.array(dialogue_offsets, dtype=np.int64),
+               'agents': np.array(agents, dtype=np.int8),
+              }
+    for stage in STAGES:
+        columns['%s_tokens' % stage] = np.array(tokens[stage], dtype=np.int32)
+        columns['%s_offsets' % stage] = np.array(offsets[stage], dtype=np.int64)
+
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for name, column in columns.iteritems():
+        np.save(_column_path(tmp_path, name), column)
+    write_pickle({'version': VERSION, 'symbols': symbols}, os.path.join(tmp_path, 'meta.pkl'))
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Written by another process meanwhile
+        shutil.rmtree(tmp_path)
+
+def read_dialogues(path):
+    '''
+    Return (symbols, columns) of a cache entry written by write_dialogues, with columns
+    memory-mapped, or None if the entry does not exist or has a different version.
+    '''
+    meta_path = os.path.join(path, 'meta.pkl')
+    if not os.path.exists(meta_path):
+        return None
+    meta = read_pickle(meta_path)
+    if meta['version'] != VERSION:
+        return None
+    names = ['examples', 'matched_items', 'dialogue_offsets', 'agents']
+    for stage in STAGES:
+        names.extend(['%s_tokens' % stage, '%s_offsets' % stage])
+    columns = {name: np.load(_column_path(path, name), mmap_mode='r') for name in names}
+    return meta['symbols'], columns
@@ -275,21 +275,11 @@ class FactEvaluator(object):
         num, ent = span
         ent = ent[1]  # take the canonical form
         num = self.str_to_num(num)
-        count = 0
-        for i, item in enumerate(kb.items):
-            for entity in self.item_entities(item):
-                if entity == ent:
-                    count += 1
+        count = len(kb.entity_rows.get(ent, ()))
         if num == count:
             #print 'correct single'
             logstats.update_summary_map(self.summary_map, {'correct_single': 1})
 
-    def item_entities(self, item):
-        attrs = sorted(item.items(), key=lambda x: x[0])
-        for attr_name, value in attrs:
-            type_ = Graph.metadata.attribute_types[attr_name]
-            yield (value.lower(), type_)
-
     def eval_joint(self, kb, span):
         #print 'eval_joint:', span
         logstats.update_summary_map(self.summary_map, {'joint_fact': 1})
@@ -306,11 +296,7 @@ class FactEvaluator(object):
             logstats.update_summary_map(self.summary_map, {'same_col': 1})
             return
         num = self.str_to_num(num)
-        count = 0
-        for i, item in enumerate(kb.items):
-            entities = [entity for entity in self.item_entities(item)]
-            if ent1 in entities and ent2 in entities:
-                count += 1
+        count = len(set(kb.entity_rows.get(ent1, ())).intersection(kb.entity_rows.get(ent2, ())))
         #print 'correct joint ent'
         logstats.update_summary_map(self.summary_map, {'correct_joint_ent': 1})
         if count == num:
@@ -237,35 +237,54 @@ class GraphBatch(object):
           we will get updated utterance matrices from GraphEmbedder.
         - node_ids, entity_ids, paths, node_paths, node_feats
         '''
+        batch = self.get_graph_data(encoder_tokens, decoder_tokens, encoder_entities, decoder_entities)
+        return self.add_utterances(batch, utterances)
+
+    def get_graph_data(self, encoder_tokens, decoder_tokens, encoder_entities, decoder_entities):
+        '''
+        Update graphs with the tokens and construct the batched inputs that do not depend on
+        the model, i.e. all but utterances (see add_utterances). They can be computed ahead
+        of running the model as long as batches of the graphs are processed in order.
+        '''
         encoder_entity_lists = self.update_graph(encoder_tokens, stage='encoding')
         decoder_entity_lists = self.update_graph(decoder_tokens, stage='decoding')
 
         max_num_nodes = self._max_num_nodes()
-        if utterances is None:
-            # Encoder utterances and decoder utterances
-            utterances = (self._batch_zero_utterances(max_num_nodes),
-                          self._batch_zero_utterances(max_num_nodes))
-        else:
-            utterances = self.update_utterances(utterances, max_num_nodes)
-
         max_num_paths = self._max_num_paths()
         max_num_paths_per_node = self._max_num_paths_per_node()
         # TODO: entities -> update_entities
         batch = {
+                 'max_num_nodes': max_num_nodes,
                  'node_ids': self._batch_node_ids(max_num_nodes),
                  'mask': self._batch_mask(max_num_nodes),
                  'entity_ids': self._batch_entity_ids(max_num_nodes),
                  'paths': self._batch_paths(max_num_paths),
                  'node_paths': self._batch_node_paths(max_num_nodes, max_num_paths_per_node),
                  'node_feats': self._batch_node_feats(max_num_nodes),
-                 'utterances': utterances,
-                 'encoder_entities': self._batch_entity_lists(encoder_entity_lists, self.pad_utterance_id),
-                 'decoder_entities': self._batch_entity_lists(decoder_entity_lists, self.pad_utterance_id),
+                 'encoder_entity_lists': encoder_entity_lists,
+                 'decoder_entity_lists': decoder_entity_lists,
                  'encoder_nodes': None if encoder_entities is None else self._entity_to_node_id(encoder_entities),
                  'decoder_nodes': None if decoder_entities is None else self._entity_to_node_id(decoder_entities),
                 }
         return batch
 
+    def add_utterances(self, batch, utterances):
+        '''
+        Add utterance matrices (and entity lists indexing them) to a batch from get_graph_data.
+        utterances: None at the beginning of a dialogue, otherwise updated utterance matrices from GraphEmbedder.
+        '''
+        max_num_nodes = batch['max_num_nodes']
+        if utterances is None:
+            # Encoder utterances and decoder utterances
+            utterances = (self._batch_zero_utterances(max_num_nodes),
+                          self._batch_zero_utterances(max_num_nodes))
+        else:
+            utterances = self.update_utterances(utterances, max_num_nodes)
+        batch['utterances'] = utterances
+        batch['encoder_entities'] = self._batch_entity_lists(batch['encoder_entity_lists'], self.pad_utterance_id)
+        batch['decoder_entities'] = self._batch_entity_lists(batch['decoder_entity_lists'], self.pad_utterance_id)
+        return batch
+
 class Graph(object):
     '''
     Maintain a (dynamic) knowledge graph of the agent.
@@ -330,23 +349,21 @@ class Graph(object):
         and 2 types of paths: (item, has_attr, entity) and (attr has entity)
         '''
         attr_ents = defaultdict(set)  # Entities of each attribute
-        for i, item in enumerate(kb.items):
+        # Columns of the KB in the order of attribute names
+        columns = [(j, attr.name.lower()) for j, attr in sorted(enumerate(kb.attributes), key=lambda x: x[1].name)]
+        for i in xrange(len(kb.items)):
             # Item nodes
             item_node = (item_to_str(i), 'item')
             #item_name = item_to_str(i)
             #item_node = (item_name, item_name)
             self.nodes.add_word(item_node)
-            attrs = sorted(item.items(), key=lambda x: x[0])
-            for attr_name, value in attrs:
-                type_ = Graph.metadata.attribute_types[attr_name]
-                attr_name = attr_name.lower()
-                value = value.lower()
+            for j, attr_name in columns:
                 # Attribute nodes
                 attr_node = (attr_name, 'attr')
                 #attr_node = (attr_name, attr_name)
                 self.nodes.add_word(attr_node)
                 # Entity nodes
-                entity_node = (value, type_)
+                entity_node = kb.entity(i, j)
                 self.nodes.add_word(entity_node)
                 # Path: item has_attr entity
                 self._add_path(item_node, attr_name, entity_node)
@@ -9,7 +9,9 @@ from lib import logstats
 from vocab import is_entity
 import resource
 import numpy as np
+from itertools import imap, izip
 from model.util import EPS
+from basic.util import prefetch
 
 def memory():
     usage=resource.getrusage(resource.RUSAGE_SELF)
@@ -26,6 +28,7 @@ def add_learner_arguments(parser):
     parser.add_argument('--init-from', help='Initial parameters')
     parser.add_argument('--checkpoint', default='.', help='Directory to save learned models')
     parser.add_argument('--gpu', type=int, default=0, help='Use GPU or not')
+    parser.add_argument('--prefetch', type=int, default=0, help='Number of training batches to prepare ahead in a background thread (0 to disable)')
 
 optim = {'adagrad': tf.train.AdagradOptimizer,
          'sgd': tf.train.GradientDescentOptimizer,
@@ -39,8 +42,10 @@ class Learner(object):
         self.vocab = data.mappings['vocab']
         if type(model).__name__ == 'BasicEncoderDecoder':
             self._run_batch = self._run_batch_basic
+            self._prepare_batch = self._prepare_batch_basic
         elif type(model).__name__ == 'GraphEncoderDecoder':
             self._run_batch = self._run_batch_graph
+            self._prepare_batch = self._prepare_batch_graph
         self.batch_size = batch_size
         self.evaluator = evaluator
         self.verbose = verbose
@@ -56,15 +61,13 @@ class Learner(object):
         return summary_map['total_loss']['sum'] / (summary_map['num_tokens']['sum'] + EPS)
 
     # TODO: don't need graphs in the parameters
-    def _get_feed_dict(self, batch, encoder_init_state=None, graph_data=None, graphs=None, copy=False, init_checklists=None, encoder_nodes=None, decoder_nodes=None, matched_items=None):
+    def _get_feed_dict(self, batch, encoder_init_state=None, graph_data=None, graphs=None, copy=False, init_checklists=None, encoder_nodes=None, decoder_nodes=None, matched_items=None, targets=None):
         # NOTE: We need to do the processing here instead of in preprocess because the
         # graph is dynamic; also the original batch data should not be modified.
-        if copy:
-            targets = graphs.copy_targets(batch['targets'], self.vocab.size)
-            matched_items = graphs.copy_targets(np.reshape(matched_items, [-1, 1]), self.vocab.size)
-            matched_items = np.reshape(matched_items, [-1])
-        else:
+        if targets is None:
             targets = batch['targets']
+        if copy:
+            targets, matched_items = self._copy_targets(graphs, targets, matched_items)
 
         encoder_args = {'inputs': batch['encoder_inputs'],
                 'last_inds': batch['encoder_inputs_last_inds'],
@@ -113,18 +116,48 @@ class Learner(object):
             print 'PRED:', self.data.textint_map.int_to_text(preds[i], 'target')
             print 'LOSS:', loss[i]
 
-    def _run_batch_graph(self, dialogue_batch, sess, summary_map, test=False):
+    def _copy_targets(self, graphs, targets, matched_items):
+        targets = graphs.copy_targets(targets, self.vocab.size)
+        matched_items = graphs.copy_targets(np.reshape(matched_items, [-1, 1]), self.vocab.size)
+        matched_items = np.reshape(matched_items, [-1])
+        return targets, matched_items
+
+    def _prepare_batch_basic(self, dialogue_batch):
+        return dialogue_batch, None
+
+    def _prepare_batch_graph(self, dialogue_batch):
+        '''
+        Compute inputs of each batch in the sequence that do not depend on the model: graph data
+        except utterances (see GraphBatch.get_graph_data), checklists and copied targets.
+        Return (dialogue_batch, inputs).
+        '''
+        graphs = dialogue_batch['graph']
+        inputs = []
+        for batch in dialogue_batch['batch_seq']:
+            graph_data = graphs.get_graph_data(batch['encoder_tokens'], batch['decoder_tokens'], batch['encoder_entities'], batch['decoder_entities'])
+            targets, matched_items = batch['targets'], dialogue_batch['matched_items']
+            if self.data.copy:
+                targets, matched_items = self._copy_targets(graphs, targets, matched_items)
+            inputs.append({'graph_data': graph_data,
+                           'init_checklists': graphs.get_zero_checklists(1),
+                           'targets': targets,
+                           'matched_items': matched_items,
+                          })
+        return dialogue_batch, inputs
+
+    def _run_batch_graph(self, dialogue_batch, sess, summary_map, test=False, inputs=None):
         '''
         Run truncated RNN through a sequence of batch examples with knowledge graphs.
+        inputs: precomputed by _prepare_batch_graph
         '''
         encoder_init_state = None
         utterances = None
         graphs = dialogue_batch['graph']
-        matched_items = dialogue_batch['matched_items']
-        for i, batch in enumerate(dialogue_batch['batch_seq']):
-            graph_data = graphs.get_batch_data(batch['encoder_tokens'], batch['decoder_tokens'], batch['encoder_entities'], batch['decoder_entities'], utterances, self.vocab)
-            init_checklists = graphs.get_zero_checklists(1)
-            feed_dict = self._get_feed_dict(batch, encoder_init_state, graph_data, graphs, self.data.copy, init_checklists, graph_data['encoder_nodes'], graph_data['decoder_nodes'], matched_items)
+        if inputs is None:
+            _, inputs = self._prepare_batch_graph(dialogue_batch)
+        for i, (batch, batch_inputs) in enumerate(izip(dialogue_batch['batch_seq'], inputs)):
+            graph_data = graphs.add_utterances(batch_inputs['graph_data'], utterances)
+            feed_dict = self._get_feed_dict(batch, encoder_init_state, graph_data, graphs, False, batch_inputs['init_checklists'], graph_data['encoder_nodes'], graph_data['decoder_nodes'], batch_inputs['matched_items'], batch_inputs['targets'])
             if test:
                 logits, final_state, utterances, loss, seq_loss, total_loss = sess.run(
                         [self.model.decoder.output_dict['logits'],
@@ -156,7 +189,7 @@ class Learner(object):
                 logstats.update_summary_map(summary_map, {'loss': loss})
                 logstats.update_summary_map(summary_map, {'grad_norm': gn})
 
-    def _run_batch_basic(self, dialogue_batch, sess, summary_map, test=False):
+    def _run_batch_basic(self, dialogue_batch, sess, summary_map, test=False, inputs=None):
         '''
         Run truncated RNN through a sequence of batch examples.
         '''
@@ -215,6 +248,10 @@ class Learner(object):
         # Training loop
         train_data = self.data.generator(split, self.batch_size)
         num_per_epoch = train_data.next()
+        if args.prefetch > 0:
+            train_data = prefetch(imap(self._prepare_batch, train_data), args.prefetch)
+        else:
+            train_data = imap(self._prepare_batch, train_data)
         step = 0
         saver = tf.train.Saver()
         save_path = os.path.join(args.checkpoint, 'tf_model.ckpt')
@@ -238,8 +275,10 @@ class Learner(object):
             while True:
                 print '================== Epoch %d ==================' % (epoch)
                 for i in xrange(num_per_epoch):
+                    # Include preparing the batch (or waiting for it when prefetching)
                     start_time = time.time()
-                    self._run_batch(train_data.next(), sess, summary_map, test=False)
+                    dialogue_batch, inputs = train_data.next()
+                    self._run_batch(dialogue_batch, sess, summary_map, test=False, inputs=inputs)
                     end_time = time.time()
                     logstats.update_summary_map(summary_map, \
                             {'time(s)/batch': end_time - start_time, \
@@ -2,11 +2,16 @@
 Preprocess examples in a dataset and generate data for models.
 '''
 
+import os
 import random
 import re
+import time
 import numpy as np
 from src.model.vocab import Vocabulary, is_entity
 from src.model.graph import Graph, GraphBatch, inv_rel, item_to_str
+from src.model.data_cache import cache_key, read_dialogues, write_dialogues
+from src.basic.util import LRUCache
+from src.lib import logstats
 from itertools import chain, izip
 from collections import namedtuple, defaultdict
 import copy
@@ -15,21 +20,59 @@ def add_preprocess_arguments(parser):
     parser.add_argument('--entity-encoding-form', choices=['type', 'canonical'], default='canonical', help='Input entity form to the encoder')
     parser.add_argument('--entity-decoding-form', choices=['canonical', 'type'], default='canonical', help='Input entity form to the decoder')
     parser.add_argument('--entity-target-form', choices=['canonical', 'type', 'graph'], default='canonical', help='Output entity form to the decoder')
+    parser.add_argument('--data-cache', help='Directory to cache preprocessed dialogues in; later runs on the same data read them from there')
+    parser.add_argument('--batch-cache-size', type=int, default=0, help='Number of recently used batches to keep in memory (batches are created when needed)')
+    parser.add_argument('--preprocess-workers', type=int, default=1, help='Number of processes linking entities in the examples of each split (the dialogues do not depend on it)')
+    parser.add_argument('--max-batch-tokens', type=int, help='Maximum number of (padded) tokens in a batch; dialogues of similar turn lengths are batched together, up to --batch-size dialogues')
 
 SpecialSymbols = namedtuple('SpecialSymbols', ['EOS', 'GO', 'SELECT', 'PAD', 'EOE'])
 markers = SpecialSymbols(EOS='</s>', GO='<go>', SELECT='<select>', PAD='<pad>', EOE='</e>')
 
-def tokenize(utterance):
+class Tokenizer(object):
     '''
     'hi there!' => ['hi', 'there', '!']
+    Tokens are interned so that repeated tokens (e.g. in all dialogues of a corpus) share string objects.
+    The intern table keeps the first (about) max_tokens distinct tokens, so that tokenizing arbitrary
+    text (e.g. in a web session) doesn't grow it without bound.
     '''
-    utterance = utterance.encode('utf-8').lower()
-    # Remove '-' to match lexicon preprocess
-    for s in (' - ', '-'):
-        utterance = utterance.replace(s, ' ')
-    # Split on punctuation
-    tokens = re.findall(r"[\w']+|[.,!?;&-]", utterance)
-    return tokens
+    # Split on punctuation ('-' is removed before to match lexicon preprocess)
+    pattern = re.compile(r"[\w']+|[.,!?;&]")
+
+    def __init__(self, intern=True, max_tokens=100000):
+        self.intern = intern
+        self.max_tokens = max_tokens
+        self.tokens = {}
+
+    def __reduce__(self):
+        # Pickle (e.g. for workers of fork_map) without the intern table
+        return (Tokenizer, (self.intern, self.max_tokens))
+
+    def _intern(self, tokens):
+        if not self.intern:
+            return tokens
+        if len(self.tokens) < self.max_tokens:
+            setdefault = self.tokens.setdefault
+            return [setdefault(token, token) for token in tokens]
+        # Table is full: only reuse interned tokens
+        get = self.tokens.get
+        return [get(token, token) for token in tokens]
+
+    def __call__(self, utterance):
+        return self._intern(self.pattern.findall(utterance.encode('utf-8').lower().replace('-', ' ')))
+
+    def tokenize_batch(self, utterances):
+        '''
+        Tokenize a list of utterances, encoding and lowercasing them all at once.
+        '''
+        utterances = list(utterances)
+        lines = u'\n'.join(utterances).encode('utf-8').lower().replace('-', ' ').split('\n')
+        # Some utterances are multi-line
+        if len(lines) != len(utterances):
+            return [self(utterance) for utterance in utterances]
+        findall = self.pattern.findall
+        return [self._intern(findall(line)) for line in lines]
+
+tokenize = Tokenizer()
 
 word_to_num = {'one': '1', 'two': '2', 'three': '3', 'four': '4', 'five': '5', 'six': '6', 'seven': '7', 'eight': '8', 'nine': '9', 'ten': '10'}
 def normalize_number(token):
@@ -105,6 +148,7 @@ class TextIntMap(object):
         self.entity_forms = preprocessor.entity_forms
         self.preprocessor = preprocessor
         self.setting = {k: self.use_entity_map(v) for k, v in self.entity_forms.iteritems()}
+        self.entity_vocab_inds = {k: {} for k in self.entity_forms}  # stage -> {entity ind: vocab ind}
 
     def pred_to_input(self, preds):
         '''
@@ -131,16 +175,25 @@ class TextIntMap(object):
 
         use_entity_map = self.setting[stage]
         # If use_entity_map, nothing needs to be done as entities are already mapped by the entity_map
-        if not use_entity_map:
+        if not use_entity_map and entity_inds.any():
             # Entities needs to be transformed and mapped by vocab
-            for tok_int, is_ent in izip(np.nditer(token_array, op_flags=['readwrite']), np.nditer(entity_inds)):
-                if is_ent:
-                    entity = self.entity_map.to_word(tok_int - offset)
-                    # NOTE: at this point we have lost the surface form of the entity: using an empty string
-                    processed_entity = self.preprocessor.get_entity_form(('', entity), self.entity_forms[stage])
-                    tok_int[...] = self.vocab.to_ind(processed_entity)
+            entities, inverse = np.unique(entity_array[entity_inds], return_inverse=True)
+            vocab_inds = np.array([self.entity_to_vocab_ind(entity, stage) for entity in entities], dtype=np.int32)
+            token_array[entity_inds] = vocab_inds[inverse]
         return token_array, entity_array
 
+    def entity_to_vocab_ind(self, entity_ind, stage):
+        '''
+        Vocab index of the entity (by entity_map) transformed to the entity form of stage.
+        '''
+        vocab_inds = self.entity_vocab_inds[stage]
+        if entity_ind not in vocab_inds:
+            entity = self.entity_map.to_word(entity_ind)
+            # NOTE: at this point we have lost the surface form of the entity: using an empty string
+            processed_entity = self.preprocessor.get_entity_form(('', entity), self.entity_forms[stage])
+            vocab_inds[entity_ind] = self.vocab.to_ind(processed_entity)
+        return vocab_inds[entity_ind]
+
     def use_entity_map(self, entity_form):
         if entity_form == 'graph':
             return True
@@ -184,34 +237,33 @@ class Dialogue(object):
     TARGET = 2
     num_stages = 3  # encoding, decoding, target
 
-    def __init__(self, kbs, uuid):
+    def __init__(self, kbs, uuid, matched_items=None):
         '''
         Dialogue data that is needed by the model.
+        matched_items: ids of the item shared by the two KBs, if known (see Scenario.get_matched_items)
         '''
         self.uuid = uuid
         self.kbs = kbs
-        self.matched_items = self.get_correct_item(kbs)
+        self.matched_items = matched_items if matched_items is not None else self.get_correct_item(kbs)
         # token_turns: tokens and entitys (output of entitylink)
         self.token_turns = ([], [])
         # entities: -1 for non-entity words, entities are mapped based on entity_map
         self.entities = ([], [])
         # turns: input tokens of encoder, decoder input and target, later converted to integers
         self.turns = ([], [], [])
+        # flat_turns: (tokens, turn offsets) of each stage, replacing turns once flattened
+        self.flat_turns = None
+        self.turn_lengths = None
         self.agents = []
         self.is_int = False  # Whether we've converted it to integers
         self.flattened = False
 
     @classmethod
     def get_correct_item(cls, kbs):
-        for id1, item1 in enumerate(kbs[0].items):
-            for id2, item2 in enumerate(kbs[1].items):
-                if item1 == item2:
-                    return (id1, id2)
-        raise Exception('No matched item.')
-
-    def create_graph(self):
-        assert not hasattr(self, 'graphs')
-        self.graphs = [Graph(kb) for kb in self.kbs]
+        matched_items = kbs[0].match(kbs[1])
+        if matched_items is None:
+            raise Exception('No matched item.')
+        return matched_items
 
     def add_utterance(self, agent, utterances):
         # Same agent talking
@@ -237,38 +289,65 @@ class Dialogue(object):
                 for utterance in turn])
         self.is_int = True
 
+    @classmethod
+    def flatten_int_turns(cls, turns):
+        '''
+        Return a token array of turns with </s> after each utterance and offsets of turns in it.
+        '''
+        lengths = [sum(len(utterance) + 1 for utterance in turn) for turn in turns]
+        offsets = np.zeros(len(turns) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        eos = (int_markers.EOS,)
+        tokens = np.fromiter(chain.from_iterable(chain(utterance, eos) for turn in turns for utterance in turn),
+                dtype=np.int32, count=offsets[-1])
+        return tokens, offsets
+
     def flatten_turns(self):
         '''
-        Flatten turns to a list of tokens with </s> between utterances and </t> at the end.
+        Flatten turns to a token array with </s> between utterances, and token turns to lists of tokens likewise.
         '''
         if self.flattened:
             return
 
-        for i, turns in enumerate(self.turns):
-            for j, turn in enumerate(turns):
-                for utterance in turn:
-                    utterance.append(int_markers.EOS)
-                self.turns[i][j] = [x for x in chain.from_iterable(turn)]
+        if self.flat_turns is None:
+            self.flat_turns = [self.flatten_int_turns(turns) for turns in self.turns]
+            self.turns = None
 
         if hasattr(self, 'token_turns'):
-            for i, turns in enumerate(self.token_turns):
-                for j, turn in enumerate(turns):
-                    for utterance in turn:
-                        utterance.append(markers.EOS)
-                    self.token_turns[i][j] = [x for x in chain.from_iterable(turn)]
+            self.token_turns = tuple([[x for utterance in turn for x in chain(utterance, (markers.EOS,))]
+                for turn in turns] for turns in self.token_turns)
 
         self.flattened = True
 
-    def pad_turns(self, num_turns):
+    def get_turn_lengths(self):
         '''
-        Pad turns to length num_turns.
+        Number of tokens (including </s> after each utterance) of each turn.
         '''
-        turns, agents = self.turns, self.agents
-        assert len(turns[0]) == len(turns[1]) and len(turns[0]) == len(turns[2])
-        for i in xrange(len(turns[0]), num_turns):
-            agents.append(1 - agents[-1])
-            for j in xrange(len(turns)):
-                turns[j].append([])
+        if self.turn_lengths is None:
+            if self.flattened:
+                lengths = [[len(turn) for turn in turns] for turns in self.token_turns]
+            else:
+                lengths = [[sum(len(utterance) + 1 for utterance in turn) for turn in turns] for turns in self.token_turns]
+            self.turn_lengths = np.maximum(*lengths)
+        return self.turn_lengths
+
+    def get_turn(self, stage, i):
+        '''
+        Tokens of turn i of a flattened dialogue (empty for i >= number of turns).
+        '''
+        tokens, offsets = self.flat_turns[stage]
+        if i >= len(offsets) - 1:
+            return tokens[:0]
+        return tokens[offsets[i]:offsets[i+1]]
+
+    def get_agent(self, i):
+        '''
+        Agent of turn i; agents take turns after the last turn.
+        '''
+        num_turns = len(self.agents)
+        if i < num_turns:
+            return self.agents[i]
+        return self.agents[-1] if (i - num_turns) % 2 == 1 else 1 - self.agents[-1]
 
 class DialogueBatch(object):
     use_kb = False
@@ -281,37 +360,36 @@ class DialogueBatch(object):
         '''
         All dialogues in a batch should have the same number of turns.
         '''
-        max_num_turns = max([len(d.turns[0]) for d in self.dialogues])
         for dialogue in self.dialogues:
             dialogue.flatten_turns()
-            dialogue.pad_turns(max_num_turns)
-        self.num_turns = len(self.dialogues[0].turns[0])
+        # Shorter dialogues are padded with empty turns
+        self.num_turns = max([len(d.agents) for d in self.dialogues])
 
     def _normalize_turn(self, turn_batch):
         '''
         All turns at the same time step should have the same number of tokens.
+        turn_batch: token arrays of the turn of each dialogue
         '''
-        max_num_tokens = max([len(t) for t in turn_batch])
+        lengths = np.array([len(t) for t in turn_batch])
+        max_num_tokens = lengths.max()
         batch_size = len(turn_batch)
         T = np.full([batch_size, max_num_tokens+1], int_markers.PAD, dtype=np.int32)
-        for i, turn in enumerate(turn_batch):
-            T[i, 1:len(turn)+1] = turn
-            # Insert <go> at the beginning at each turn because for decoding we want to
-            # start from <go> to generate, except for padded turns
-            if T[i][1] != int_markers.PAD:
-                T[i][0] = int_markers.GO
+        T[:, 1:][np.arange(max_num_tokens) < lengths[:, np.newaxis]] = np.concatenate(turn_batch)
+        # Insert <go> at the beginning at each turn because for decoding we want to
+        # start from <go> to generate, except for padded turns
+        T[lengths > 0, 0] = int_markers.GO
         return T
 
     def _create_turn_batches(self):
         turn_batches = []
         for i in xrange(Dialogue.num_stages):
             turn_batches.append([self._normalize_turn(
-                [dialogue.turns[i][j] for dialogue in self.dialogues])
+                [dialogue.get_turn(i, j) for dialogue in self.dialogues])
                 for j in xrange(self.num_turns)])
         return turn_batches
 
     def _get_agent_batch(self, i):
-        return [dialogue.agents[i] for dialogue in self.dialogues]
+        return [dialogue.get_agent(i) for dialogue in self.dialogues]
 
     def _get_kb_batch(self, agents):
         return [dialogue.kbs[agent] for dialogue, agent in izip(self.dialogues, agents)]
@@ -321,7 +399,8 @@ class DialogueBatch(object):
         return Dialogue.textint_map.text_to_int(item_entities, 'target')
 
     def _get_graph_batch(self, agents):
-        return GraphBatch([dialogue.graphs[agent] for dialogue, agent in izip(self.dialogues, agents)])
+        # Graphs are created with the batch (and freed with it)
+        return GraphBatch([Graph(dialogue.kbs[agent]) for dialogue, agent in izip(self.dialogues, agents)])
 
     def _remove_last(self, array, value):
         '''
@@ -329,12 +408,10 @@ class DialogueBatch(object):
         The last token input to decoder should not be </s> otherwise the model will learn
         </s> <pad> (deterministically).
         '''
-        nrows, ncols = array.shape
-        for i in xrange(nrows):
-            for j in xrange(ncols-1, -1, -1):
-                if array[i][j] == value:
-                    array[i][j] = int_markers.PAD
-                    break
+        is_value = array[:, ::-1] == value
+        rows = np.flatnonzero(is_value.any(axis=1))
+        cols = array.shape[1] - 1 - np.argmax(is_value[rows], axis=1)
+        array[rows, cols] = int_markers.PAD
         return array
 
     def _create_one_batch(self, encode_turn, decode_turn, target_turn, encode_tokens, decode_tokens):
@@ -391,33 +468,37 @@ class DialogueBatch(object):
         return [dialogue.token_turns[stage][i] if i < len(dialogue.token_turns[stage]) else ''
                 for dialogue in self.dialogues]
 
-    def create_batches(self):
+    def create_batch(self, start_encode):
+        '''
+        Create the batch where turns start_encode, start_encode+2, ... are encoded and the next
+        turns are decoded (start_encode is 0 or 1).
+        '''
         self._normalize_dialogue()
         turn_batches = self._create_turn_batches()  # (batch_size, num_turns)
         # A sequence of batches should be processed in turn as the state of each batch is
         # passed on to the next batch
-        batches = []
         enc, dec, tgt = Dialogue.ENC, Dialogue.DEC, Dialogue.TARGET
-        for start_encode in (0, 1):
-            encode_turn_ids = range(start_encode, self.num_turns-1, 2)
-            batch_seq = [self._create_one_batch(turn_batches[enc][i], turn_batches[dec][i+1], turn_batches[tgt][i+1], self._get_token_turns(i, enc), self._get_token_turns(i+1, dec)) for i in encode_turn_ids]
-            if start_encode == 1:
-                # We still want to generate the first turn
-                batch_seq.insert(0, self._create_one_batch(None, turn_batches[dec][0], turn_batches[tgt][0], None, self._get_token_turns(0, dec)))
-            # Add agents and kbs
-            agents = self._get_agent_batch(1 - start_encode)  # Decoding agent
-            kbs = self._get_kb_batch(agents)
-            matched_items = self._get_matched_item_batch(agents)
-            batch = {
-                     'agent': agents,
-                     'kb': kbs,
-                     'matched_items': matched_items,
-                     'batch_seq': batch_seq,
-                    }
-            if self.use_kb:
-                batch['graph'] = self._get_graph_batch(agents)
-            batches.append(batch)
-        return batches
+        encode_turn_ids = range(start_encode, self.num_turns-1, 2)
+        batch_seq = [self._create_one_batch(turn_batches[enc][i], turn_batches[dec][i+1], turn_batches[tgt][i+1], self._get_token_turns(i, enc), self._get_token_turns(i+1, dec)) for i in encode_turn_ids]
+        if start_encode == 1:
+            # We still want to generate the first turn
+            batch_seq.insert(0, self._create_one_batch(None, turn_batches[dec][0], turn_batches[tgt][0], None, self._get_token_turns(0, dec)))
+        # Add agents and kbs
+        agents = self._get_agent_batch(1 - start_encode)  # Decoding agent
+        kbs = self._get_kb_batch(agents)
+        matched_items = self._get_matched_item_batch(agents)
+        batch = {
+                 'agent': agents,
+                 'kb': kbs,
+                 'matched_items': matched_items,
+                 'batch_seq': batch_seq,
+                }
+        if self.use_kb:
+            batch['graph'] = self._get_graph_batch(agents)
+        return batch
+
+    def create_batches(self):
+        return [self.create_batch(start_encode) for start_encode in (0, 1)]
 
 class Preprocessor(object):
     '''
@@ -455,16 +536,21 @@ class Preprocessor(object):
         else:
             return [self.get_entity_form(x, self.entity_forms[stage]) if is_entity(x) else x for x in utterance]
 
-    def _process_example(self, ex):
+    def _process_example(self, ex, linked_events=None):
         '''
         Convert example to turn-based dialogue.
+        linked_events: messages already linked by link_corpus
         '''
         kbs = ex.scenario.kbs
-        dialogue = Dialogue(kbs, ex.uuid)
+        dialogue = Dialogue(kbs, ex.uuid, ex.scenario.get_matched_items())
 
         mentioned_entities = set()
-        for e in ex.events:
-            utterances = self.process_event(e, kbs[e.agent], mentioned_entities)
+        for i, e in enumerate(ex.events):
+            if linked_events is not None and e.action == 'message':
+                entity_tokens = linked_events[i]
+                utterances = (entity_tokens, copy.copy(entity_tokens)) if entity_tokens else None
+            else:
+                utterances = self.process_event(e, kbs[e.agent], mentioned_entities)
             if utterances:
                 dialogue.add_utterance(e.agent, utterances)
                 for token in utterances[0]:
@@ -486,11 +572,7 @@ class Preprocessor(object):
         '''
         Return id of the item in kb.
         '''
-        item_id = None
-        for i, it in enumerate(kb.items):
-            if it == item:
-                item_id = i
-                break
+        item_id = kb.item_id(item)
         if item_id is None:
             kb.dump()
             print item
@@ -521,21 +603,45 @@ class Preprocessor(object):
         else:
             raise ValueError('Unknown event action.')
 
+    def link_corpus(self, examples, workers=1, agent=None):
+        '''
+        Link messages of all examples in parallel (see Lexicon.link_corpus).
+        For each example, yield the normalized entity tokens of each event (None for non-message
+        events and empty messages), i.e. the encoding tokens of process_event.
+        '''
+        for linked_events in self.lexicon.link_corpus(examples, workers=workers, tokenize=tokenize, agent=agent):
+            utterances = []
+            for entity_tokens in linked_events:
+                if entity_tokens:
+                    entity_tokens = [normalize_number(x) if not is_entity(x) else x for x in entity_tokens]
+                utterances.append(entity_tokens or None)
+            yield utterances
+
     @classmethod
     def count_words(cls, examples):
         counts = defaultdict(int)
         for ex in examples:
-            for event in ex.events:
-                if event.action == 'message':
-                    tokens = tokenize(event.data)
-                    for token in tokens:
-                        counts[token] += 1
+            messages = [event.data for event in ex.events if event.action == 'message']
+            for tokens in tokenize.tokenize_batch(messages):
+                for token in tokens:
+                    counts[token] += 1
         return counts
 
-    def preprocess(self, examples):
-        dialogues = []
-        for ex in examples:
-            d = self._process_example(ex)
+    def iter_dialogues(self, examples, workers=1, progress=0):
+        '''
+        Yield (index of the example, dialogue) of complete chats.
+        Messages are linked by |workers| processes (see link_corpus), in the same way and order as in
+        one process; the dialogues are created in this process so that they share its KBs.
+        progress: print the number of processed examples every |progress| examples (0 to disable).
+        '''
+        # Read once: examples are iterated by both link_corpus and here
+        examples = list(examples)
+        start_time = time.time()
+        for i, (ex, linked_events) in enumerate(izip(examples, self.link_corpus(examples, workers))):
+            if progress > 0 and i > 0 and i % progress == 0:
+                elapsed = time.time() - start_time
+                print '%d/%d examples (%.1f examples/s)' % (i, len(examples), i / elapsed)
+            d = self._process_example(ex, linked_events)
             # Skip incomplete chats
             if len(d.agents) < 2 or ex.outcome['reward'] == 0:
                 continue
@@ -543,11 +649,21 @@ class Preprocessor(object):
                 for event in ex.events:
                     print event.to_dict()
             else:
-                dialogues.append(d)
-        return dialogues
+                yield i, d
+
+    def preprocess(self, examples, workers=1):
+        return [d for i, d in self.iter_dialogues(examples, workers)]
 
 class DataGenerator(object):
-    def __init__(self, train_examples, dev_examples, test_examples, preprocessor, schema, num_items, mappings=None, use_kb=False, copy=False):
+    def __init__(self, train_examples, dev_examples, test_examples, preprocessor, schema, num_items, mappings=None, use_kb=False, copy=False, cache=None, batch_cache_size=0, max_batch_tokens=None, workers=1):
+        '''
+        cache: directory of preprocessed dialogues (see data_cache); None to always preprocess.
+        workers: number of processes preprocessing examples (see Preprocessor.iter_dialogues).
+        batch_cache_size: number of recently used batches kept by generator.
+        max_batch_tokens: token budget of a batch (see sort_dialogues); None for batches of batch_size dialogues.
+        '''
+        self.batch_cache_size = batch_cache_size
+        self.max_batch_tokens = max_batch_tokens
         examples = {'train': train_examples or [], 'dev': dev_examples or [], 'test': test_examples or []}
         self.num_examples = {k: len(v) if v else 0 for k, v in examples.iteritems()}
         self.use_kb = use_kb  # Whether to generate graph
@@ -556,7 +672,8 @@ class DataGenerator(object):
         DialogueBatch.use_kb = use_kb
         DialogueBatch.copy = copy
 
-        self.dialogues = {k: preprocessor.preprocess(v)  for k, v in examples.iteritems()}
+        self.cached = {}  # fold -> (symbols, columns) of dialogues read from cache
+        self.dialogues = {k: self.preprocess(preprocessor, k, v, cache, workers) for k, v in examples.iteritems()}
 
         for fold, dialogues in self.dialogues.iteritems():
             print '%s: %d dialogues out of %d examples' % (fold, len(dialogues), self.num_examples[fold])
@@ -572,6 +689,89 @@ class DataGenerator(object):
         global int_markers
         int_markers = SpecialSymbols(*[mappings['vocab'].to_ind(m) for m in markers])
 
+        for fold, (symbols, columns) in self.cached.iteritems():
+            self.convert_cached_to_int(self.dialogues[fold], symbols, columns)
+
+    def preprocess(self, preprocessor, fold, examples, cache=None, workers=1):
+        '''
+        Return dialogues of examples, read from cache if they have been preprocessed before.
+        '''
+        if not examples:
+            return []
+        if cache is not None:
+            path = os.path.join(cache, cache_key(examples, preprocessor))
+            cached = read_dialogues(path)
+            if cached is not None:
+                print 'Read %s dialogues from %s' % (fold, path)
+                self.cached[fold] = cached
+                return self.load_dialogues(examples, *cached)
+
+        start_time = time.time()
+        example_ids, dialogues = [], []
+        for i, d in preprocessor.iter_dialogues(examples, workers, progress=1000):
+            example_ids.append(i)
+            dialogues.append(d)
+        elapsed = time.time() - start_time
+        print 'Preprocessed %d %s examples in %.2fs (%.1f examples/s, %d workers)' % (len(examples), fold, elapsed, len(examples) / max(elapsed, 1e-6), workers)
+
+        if cache is not None:
+            write_dialogues(path, dialogues, example_ids)
+            print 'Cached %s dialogues in %s' % (fold, path)
+        return dialogues
+
+    def load_dialogues(self, examples, symbols, columns):
+        '''
+        Create dialogues (with token turns) from cache columns (see data_cache.write_dialogues).
+        '''
+        dialogue_offsets = columns['dialogue_offsets'].tolist()
+        agents = columns['agents'].tolist()
+        enc_offsets = columns['encoding_offsets'].tolist()
+        enc_tokens = [symbols[t] for t in columns['encoding_tokens'].tolist()]
+        dec_offsets = columns['decoding_offsets'].tolist()
+        dec_tokens = [symbols[t] for t in columns['decoding_tokens'].tolist()]
+        dialogues = []
+        for d, (ex_id, matched_items) in enumerate(izip(columns['examples'].tolist(), columns['matched_items'].tolist())):
+            ex = examples[ex_id]
+            dialogue = Dialogue(ex.scenario.kbs, ex.uuid, tuple(matched_items))
+            for u in xrange(dialogue_offsets[d], dialogue_offsets[d+1]):
+                dialogue.add_utterance(agents[u], (enc_tokens[enc_offsets[u]:enc_offsets[u+1]],
+                                                   dec_tokens[dec_offsets[u]:dec_offsets[u+1]]))
+            dialogues.append(dialogue)
+        return dialogues
+
+    def convert_cached_to_int(self, dialogues, symbols, columns):
+        '''
+        Convert dialogues read from cache to flattened integer turns (see Dialogue.flatten_turns),
+        mapping each symbol only once. Turns of all dialogues are views of one array per stage.
+        '''
+        symbol_ints = np.array([self.textint_map.text_to_int([s])[0] for s in symbols], dtype=np.int32)
+        dialogue_offsets = np.array(columns['dialogue_offsets'])
+        agents = np.array(columns['agents'])
+        # Utterances that start a turn: the first one of each dialogue and a change of speaker
+        new_turn = np.ones(len(agents), dtype=np.bool_)
+        new_turn[1:] = agents[1:] != agents[:-1]
+        new_turn[dialogue_offsets[:-1]] = True
+
+        flat_turns = []
+        for stage in ('encoding', 'decoding'):
+            offsets = np.array(columns['%s_offsets' % stage])
+            num_utterances = len(offsets) - 1
+            # Utterance u starts at offsets[u] + u once </s> is appended to each utterance
+            eos_offsets = offsets + np.arange(num_utterances + 1)
+            tokens = np.full(eos_offsets[-1], int_markers.EOS, dtype=np.int32)
+            token_inds = np.arange(offsets[-1]) + np.repeat(np.arange(num_utterances), np.diff(offsets))
+            tokens[token_inds] = symbol_ints[columns['%s_tokens' % stage]]
+            flat_turns.append((tokens, eos_offsets))
+
+        for d, dialogue in enumerate(dialogues):
+            start, end = dialogue_offsets[d], dialogue_offsets[d+1]
+            turn_starts = np.append(start + np.flatnonzero(new_turn[start:end]), end)
+            enc, dec = [(tokens[eos_offsets[start]:eos_offsets[end]], eos_offsets[turn_starts] - eos_offsets[start])
+                    for tokens, eos_offsets in flat_turns]
+            dialogue.flat_turns = [enc, dec, dec]
+            dialogue.turns = None
+            dialogue.is_int = True
+
     def convert_to_int(self):
         '''
         Convert tokens to integers.
@@ -580,24 +780,72 @@ class DataGenerator(object):
             for dialogue in dialogues:
                 dialogue.convert_to_int()
 
-    def create_dialogue_batches(self, dialogues, batch_size):
-        dialogues.sort(key=lambda d: len(d.turns[0]))
+    @classmethod
+    def padded_size(cls, turn_lengths):
+        '''
+        Number of tokens of a batch after padding each turn to the longest one in the batch.
+        turn_lengths: turn lengths of each dialogue in the batch
+        '''
+        max_lengths = np.zeros(max(len(lengths) for lengths in turn_lengths), dtype=np.int64)
+        for lengths in turn_lengths:
+            max_lengths[:len(lengths)] = np.maximum(max_lengths[:len(lengths)], lengths)
+        return len(turn_lengths) * max_lengths.sum()
+
+    def padding_efficiency(self, dialogues, batch_slices):
+        '''
+        Fraction of tokens in batches that are not padding.
+        '''
+        if not dialogues:
+            return 1.
+        num_tokens = sum(d.get_turn_lengths().sum() for d in dialogues)
+        padded_size = sum(self.padded_size([d.get_turn_lengths() for d in dialogues[start:end]])
+                for start, end in batch_slices)
+        return float(num_tokens) / padded_size
+
+    def sort_dialogues(self, dialogues, batch_size):
+        '''
+        Sort dialogues (in place) by number of turns and return (start, end) of each batch of dialogues.
+        With max_batch_tokens, dialogues of the same number of turns are also sorted by number of tokens,
+        and a batch is closed before its padded size (see padded_size) exceeds max_batch_tokens.
+        '''
         N = len(dialogues)
-        dialogue_batches = []
-        start = 0
-        while start < N:
+        if self.max_batch_tokens is None:
+            dialogues.sort(key=lambda d: len(d.agents))
             # NOTE: last batch may have a smaller size if we don't have enough examples
-            end = min(start + batch_size, N)
-            dialogue_batch = dialogues[start:end]
-            dialogue_batches.extend(DialogueBatch(dialogue_batch).create_batches())
-            start = end
-        return dialogue_batches
+            return [(start, min(start + batch_size, N)) for start in xrange(0, N, batch_size)]
 
-    def create_graph(self, dialogues):
-        if not self.use_kb:
-            return
+        dialogues.sort(key=lambda d: (len(d.agents), d.get_turn_lengths().sum()))
+        batch_slices = []
+        start = 0
+        max_lengths = np.zeros(0, dtype=np.int64)
+        for end, dialogue in enumerate(dialogues):
+            lengths = dialogue.get_turn_lengths()
+            # Dialogues are sorted by number of turns
+            new_max_lengths = np.array(lengths)
+            new_max_lengths[:len(max_lengths)] = np.maximum(max_lengths, lengths[:len(max_lengths)])
+            size = end - start
+            # A batch has at least one dialogue even if it is over the budget
+            if size > 0 and (size == batch_size or (size + 1) * new_max_lengths.sum() > self.max_batch_tokens):
+                batch_slices.append((start, end))
+                start = end
+                new_max_lengths = lengths
+            max_lengths = new_max_lengths
+        if start < N:
+            batch_slices.append((start, N))
+        return batch_slices
+
+    def create_batch(self, dialogues, start_encode):
         for dialogue in dialogues:
-            dialogue.create_graph()
+            dialogue.convert_to_int()
+        return DialogueBatch(dialogues).create_batch(start_encode)
+
+    def create_dialogue_batches(self, dialogues, batch_size):
+        '''
+        Create all batches of dialogues (generator creates them when needed instead).
+        '''
+        return [self.create_batch(dialogues[start:end], start_encode)
+                for start, end in self.sort_dialogues(dialogues, batch_size)
+                for start_encode in (0, 1)]
 
     def reset_graph(self, dialogue_batches):
         if not self.use_kb:
@@ -607,18 +855,32 @@ class DataGenerator(object):
                 graph.reset()
 
     def generator(self, name, batch_size, shuffle=True):
+        '''
+        Yield the number of batches per epoch, then batches (in a new random order each epoch if shuffle).
+        Batches are created when they are needed; only the batch_cache_size most recent ones are kept.
+        '''
         dialogues = self.dialogues[name]
-        for dialogue in dialogues:
-            dialogue.convert_to_int()
-        # NOTE: we assume that GraphMetadata has been constructed before DataGenerator is called
-        self.create_graph(dialogues)
-        dialogue_batches = self.create_dialogue_batches(dialogues, batch_size)
-        yield len(dialogue_batches)
-        inds = range(len(dialogue_batches))
+        batch_slices = self.sort_dialogues(dialogues, batch_size)
+        padding_efficiency = self.padding_efficiency(dialogues, batch_slices)
+        print '%s: %d batches, padding efficiency %.3f' % (name, len(batch_slices), padding_efficiency)
+        logstats.add('data', name, 'padding_efficiency', padding_efficiency)
+        # Two batches per slice: start encoding from the first or the second turn
+        num_batches = 2 * len(batch_slices)
+        yield num_batches
+        cache = LRUCache(self.batch_cache_size) if self.batch_cache_size > 0 else None
+        inds = range(num_batches)
         while True:
             if shuffle:
                 random.shuffle(inds)
             for ind in inds:
-                yield dialogue_batches[ind]
-            # We want graphs clean of dialgue history for the new epoch
-            self.reset_graph(dialogue_batches)
+                batch = cache.get(ind) if cache is not None else None
+                if batch is None:
+                    # NOTE: we assume that GraphMetadata has been constructed before batches are created
+                    start, end = batch_slices[ind / 2]
+                    batch = self.create_batch(dialogues[start:end], ind % 2)
+                    if cache is not None:
+                        cache.put(ind, batch)
+                else:
+                    # We want graphs clean of dialgue history from the last epoch
+                    self.reset_graph([batch])
+                yield batch
@@ -1,11 +1,14 @@
 import pytest
 from itertools import izip
-from model.preprocess import DialogueBatch, DataGenerator
-from basic.dataset import read_examples
+from model import preprocess
+from model.preprocess import Dialogue, DialogueBatch, DataGenerator, Preprocessor, SpecialSymbols
+from basic.dataset import Example, read_examples
+from basic.event import Event
+from basic.kb import KB
 from basic.schema import Schema
 from basic.util import read_json
 from basic.lexicon import Lexicon
-from basic.scenario_db import ScenarioDB
+from basic.scenario_db import Scenario, ScenarioDB
 from model.graph import GraphMetadata, Graph
 import numpy as np
 from numpy.testing import assert_array_equal
@@ -25,7 +28,7 @@ class TestPreprocess(object):
 
     @pytest.fixture(scope='session')
     def lexicon(self, schema):
-        return Lexicon(schema, learned_lex=False)
+        return Lexicon(schema, learned_lex=False, stop_words='data/common_words.txt')
 
     @pytest.fixture(scope='session')
     def generator(self, examples, lexicon, schema):
@@ -60,10 +63,11 @@ class TestPreprocess(object):
 
     def test_normalize_dialogue(self, generator, dialogue_batch, capsys):
         dialogue_batch._normalize_dialogue()
-        assert len(dialogue_batch.dialogues[0].turns[0]) == len(dialogue_batch.dialogues[1].turns[0])
+        assert dialogue_batch.num_turns == max([len(d.agents) for d in dialogue_batch.dialogues])
+        assert len(dialogue_batch.dialogues[0].get_turn(0, dialogue_batch.num_turns)) == 0
         with capsys.disabled():
             print '\n========== Example flattened turn =========='
-            turn = dialogue_batch.dialogues[0].turns[0][0]
+            turn = dialogue_batch.dialogues[0].get_turn(0, 0)
             print turn
             print map(generator.vocab.to_word, turn)
 
@@ -113,3 +117,82 @@ class TestPreprocess(object):
         inds = dialogue_batch._get_last_inds(inputs, pad)
         expected = np.array([2, 0])
         assert_array_equal(inds, expected)
+
+    @pytest.fixture
+    def int_markers(self, monkeypatch):
+        int_markers = SpecialSymbols(EOS=1, GO=2, SELECT=3, PAD=0, EOE=4)
+        # Set by DataGenerator from the vocab
+        monkeypatch.setattr(preprocess, 'int_markers', int_markers, raising=False)
+        return int_markers
+
+    def test_remove_last(self, int_markers):
+        pad, eos = int_markers.PAD, int_markers.EOS
+        inputs = np.array([[5, eos, 6, eos],
+                           [5, 6, 7, 8],
+                           [eos, 5, pad, pad]], dtype=np.int32)
+        expected = np.array([[5, eos, 6, pad],
+                             [5, 6, 7, 8],
+                             [pad, 5, pad, pad]], dtype=np.int32)
+        assert_array_equal(DialogueBatch([])._remove_last(inputs, eos), expected)
+
+    def test_normalize_turn(self, int_markers):
+        pad, eos, go = int_markers.PAD, int_markers.EOS, int_markers.GO
+        # Turns of two dialogues (the second one has no third turn)
+        tokens, offsets = Dialogue.flatten_int_turns([[[5, 6], [7]], [[8]], []])
+        assert_array_equal(tokens, [5, 6, eos, 7, eos, 8, eos])
+        assert_array_equal(offsets, [0, 5, 7, 7])
+        turn_batch = [tokens[offsets[0]:offsets[1]], tokens[offsets[1]:offsets[2]], tokens[:0]]
+        expected = np.array([[go, 5, 6, eos, 7, eos],
+                             [go, 8, eos, pad, pad, pad],
+                             [pad, pad, pad, pad, pad, pad]], dtype=np.int32)
+        assert_array_equal(DialogueBatch([])._normalize_turn(turn_batch), expected)
+
+    def test_padded_size(self):
+        # Turns are padded to 3, 4 and 2 tokens
+        turn_lengths = [np.array([3, 1]), np.array([2, 4, 2])]
+        assert DataGenerator.padded_size(turn_lengths) == 2 * (3 + 4 + 2)
+
+    def test_link_corpus_select(self, schema, lexicon):
+        alice = {'Name': 'Alice', 'Company': 'Google', 'Bachelors major': 'philosophy', 'Hobby': 'reading'}
+        bob = {'Name': 'Bob', 'Company': 'Apple', 'Bachelors major': 'mathematics', 'Hobby': 'hiking'}
+        carol = {'Name': 'Carol', 'Company': 'Uber', 'Bachelors major': 'linguistics', 'Hobby': 'biking'}
+        kbs = [KB.from_dict(schema.attributes, [alice, bob]), KB.from_dict(schema.attributes, [bob, carol])]
+        scenario = Scenario('S', schema.attributes, kbs)
+        # Agent 1 refers to the item selected by agent 0, which is not in its KB
+        events = [Event(0, 0, 'select', alice), Event(1, 1, 'message', 'is it readin')]
+        ex = Example(scenario, 'S', events, {'reward': 0}, 'E', None)
+        preprocessor = Preprocessor(schema, lexicon, 'canonical', 'canonical', 'canonical')
+        linked_events = next(preprocessor.link_corpus([ex]))
+        dialogue = preprocessor._process_example(ex, linked_events)
+        assert dialogue.token_turns == preprocessor._process_example(ex).token_turns
+        assert dialogue.token_turns[0][1] == [['is', 'it', ('readin', ('reading', 'hobby'))]]
+
+    def test_sort_dialogues_max_tokens(self):
+        class FakeDialogue(object):
+            def __init__(self, turn_lengths):
+                self.agents = [i % 2 for i in xrange(len(turn_lengths))]
+                self.turn_lengths = np.array(turn_lengths)
+
+            def get_turn_lengths(self):
+                return self.turn_lengths
+
+        rng = np.random.RandomState(0)
+        dialogues = [FakeDialogue(rng.randint(1, 20, size=rng.randint(2, 8))) for _ in xrange(200)]
+        # One dialogue over the budget
+        dialogues.append(FakeDialogue([100, 100]))
+        generator = DataGenerator.__new__(DataGenerator)
+        generator.max_batch_tokens = 150
+        batch_size = 8
+        batch_slices = generator.sort_dialogues(dialogues, batch_size)
+
+        # Contiguous slices covering all dialogues
+        assert batch_slices[0][0] == 0 and batch_slices[-1][1] == len(dialogues)
+        for (_, end), (start, _) in izip(batch_slices, batch_slices[1:]):
+            assert end == start
+        for start, end in batch_slices:
+            assert 0 < end - start <= batch_size
+            if end - start > 1:
+                turn_lengths = [d.get_turn_lengths() for d in dialogues[start:end]]
+                assert DataGenerator.padded_size(turn_lengths) <= generator.max_batch_tokens
+        assert [d.turn_lengths.sum() for d in dialogues if len(d.agents) == 2] == \
+                sorted(d.turn_lengths.sum() for d in dialogues if len(d.agents) == 2)
@@ -0,0 +1,38 @@
+'''
+Benchmark of DataGenerator.create_dialogue_batches on the train examples.
+'''
+
+import argparse
+import time
+from src.basic.util import iter_json
+from src.basic.dataset import add_dataset_arguments, read_dataset
+from src.basic.schema import Schema
+from src.basic.scenario_db import ScenarioDB, add_scenario_arguments
+from src.basic.lexicon import Lexicon, add_lexicon_arguments
+from src.model.preprocess import DataGenerator, Preprocessor, add_preprocess_arguments
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=32, help='Number of examples per batch')
+    parser.add_argument('--num-items', type=int, default=10, help='Maximum number of items in each KB')
+    add_scenario_arguments(parser)
+    add_lexicon_arguments(parser)
+    add_dataset_arguments(parser)
+    add_preprocess_arguments(parser)
+    args = parser.parse_args()
+
+    schema = Schema(args.schema_path)
+    scenario_db = ScenarioDB.from_dict(schema, iter_json(args.scenarios_path))
+    dataset = read_dataset(scenario_db, args)
+    lexicon = Lexicon(schema, args.learned_lex, stop_words=args.stop_words, cache=args.lexicon_cache)
+    preprocessor = Preprocessor(schema, lexicon, args.entity_encoding_form, args.entity_decoding_form, args.entity_target_form)
+    data_generator = DataGenerator(dataset.train_examples, None, None, preprocessor, schema, args.num_items, cache=args.data_cache)
+
+    dialogues = data_generator.dialogues['train']
+    start = time.time()
+    data_generator.convert_to_int()
+    print 'convert_to_int: %.2fs' % (time.time() - start)
+    start = time.time()
+    batches = data_generator.create_dialogue_batches(dialogues, args.batch_size)
+    elapsed = time.time() - start
+    print 'create_dialogue_batches: %d dialogues, %d batches in %.2fs (%.1f dialogues/s)' % (len(dialogues), len(batches), elapsed, len(dialogues) / elapsed)
@@ -0,0 +1,38 @@
+'''
+Micro-benchmark of preprocess.Tokenizer: throughput (utterances/sec) on messages of transcripts.
+'''
+
+import argparse
+import time
+from src.basic.util import iter_json
+from src.model.preprocess import Tokenizer
+
+def best_time(func, repeat):
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transcripts', nargs='+', required=True, help='Json files of transcripts')
+    parser.add_argument('--max-utterances', type=int, help='Maximum number of messages to tokenize')
+    parser.add_argument('--repeat', type=int, default=5, help='Report the best of this many runs')
+    args = parser.parse_args()
+
+    utterances = []
+    for path in args.transcripts:
+        for chat in iter_json(path):
+            utterances.extend(e['data'] for e in chat['events'] if e['action'] == 'message')
+    utterances = utterances[:args.max_utterances]
+    print '%d utterances' % len(utterances)
+
+    for intern in (False, True):
+        tokenizer = Tokenizer(intern=intern)
+        single = best_time(lambda: [tokenizer(u) for u in utterances], args.repeat)
+        batch = best_time(lambda: tokenizer.tokenize_batch(utterances), args.repeat)
+        print 'intern=%s: single %d utterances/s, batch %d utterances/s' % (intern, len(utterances) / single, len(utterances) / batch)
@@ -339,7 +339,7 @@ def get_entity_mention(summary_map, dialog, kbs):
         for k, v in attr_props.iteritems():
             summary_map['first'][k].append(v)
 
-def analyze_strategy(all_chats, scenario_db, preprocessor, text_output, lm):
+def analyze_strategy(all_chats, scenario_db, preprocessor, text_output, lm, workers=1):
     fout = open(text_output, 'w') if text_output is not None else None
     speech_act_summary_map = defaultdict(int)
     kb_strategy_summary_map = {}
@@ -359,27 +359,22 @@ def analyze_strategy(all_chats, scenario_db, preprocessor, text_output, lm):
     total_dialogues = 0.
 
     lm_summary_map = {}
-    for raw in all_chats:
-        ex = Example.from_dict(scenario_db, raw)
+    examples = (Example.from_dict(scenario_db, raw) for raw in all_chats)
+    # skip incomplete dialogues
+    examples = [ex for ex in examples if ex.outcome is not None and ex.outcome["reward"] != 0]
+    for ex, utterances in izip(examples, preprocessor.link_corpus(examples, workers)):
         kbs = ex.scenario.kbs
-        if ex.outcome is None or ex.outcome["reward"] == 0:
-            continue  # skip incomplete dialogues
         total_dialogues += 1.
         dialog = []
-        mentioned_entities = set()
         for i, event in enumerate(ex.events):
             if event.action == 'select':
                 utterance = []
             elif event.action == 'message':
-                utterance = preprocessor.process_event(event, kbs[event.agent], mentioned_entities)
+                utterance = utterances[i]
                 # Skip empty utterances
                 if not utterance:
                     continue
                 else:
-                    utterance = utterance[0]
-                    for token in utterance:
-                        if is_entity(token):
-                            mentioned_entities.add(token[1][0])
                     logstats.update_summary_map(dialog_summary_map, {'utterance_length': len(utterance)})
                     check_fact(fact_summary_map, utterance, kbs[event.agent])
                     if lm:
@@ -5,7 +5,7 @@ Takes two agent implementations and generates the dialogues.
 import argparse
 import random
 import json
-from src.basic.util import read_json
+from src.basic.util import iter_json
 from src.basic.schema import Schema
 from src.basic.scenario_db import ScenarioDB, add_scenario_arguments
 from src.basic.dataset import add_dataset_arguments
@@ -39,8 +39,8 @@ if args.random_seed:
     np.random.seed(args.random_seed)
 
 schema = Schema(args.schema_path)
-scenario_db = ScenarioDB.from_dict(schema, read_json(args.scenarios_path))
-lexicon = Lexicon(schema, args.learned_lex, stop_words=args.stop_words)
+scenario_db = ScenarioDB.from_dict(schema, iter_json(args.scenarios_path))
+lexicon = Lexicon(schema, args.learned_lex, stop_words=args.stop_words, cache=args.lexicon_cache, link_cache_size=args.link_cache_size)
 if args.inverse_lexicon:
     realizer = InverseLexicon(schema, args.inverse_lexicon)
 else:
@@ -94,3 +94,5 @@ if args.train_max_examples:
     generate_examples('train', args.train_examples_paths[0], args.train_max_examples, args.remove_fail, args.max_turns)
 if args.test_max_examples:
     generate_examples('test', args.test_examples_paths[0], args.test_max_examples, args.remove_fail, args.max_turns)
+if lexicon.link_cache is not None:
+    logstats.add('lexicon', 'link_cache', lexicon.link_cache.stats())
@@ -1,5 +1,7 @@
 import argparse
+import hashlib
 import json
+import os
 import re
 import sys
 
@@ -11,6 +13,9 @@ from src.basic.event import Event
 from src.model.vocab import is_entity
 from src.model.preprocess import Preprocessor
 from src.basic.dataset import Example
+from itertools import chain
+from src.basic.inverse_lexicon import read_count_store, write_count_store
+from src.basic.util import iter_json
 
 
 """
@@ -21,16 +26,73 @@ should be of form:
     <entity \t <span> \t <type>
 
 for each entity linked by lexicon
+
+With --counts, realizations of chats not seen before are merged into a
+count store (see InverseLexicon) instead of relinking all data.
 """
 
+def link_annotated_examples(lexicon, annotated_examples):
+    """
+    Yield (entity, span, type) of entities linked in annotated examples
+    """
+    re_pattern = r"[\w*\']+|[(\w*&)]+|[\w]+|\.|\(|\)|\\|\"|\/|;|\#|\$|\%|\@|\{|\}|\:"
+    for ex in annotated_examples:
+        scenario_uuid = ex["scenario_uuid"]
+
+        for e in ex["events"]:
+            msg_data = e["data"]
+            action = e["action"]
+            agent = e["agent"]
+
+            if action == "message":
+                raw_tokens = re.findall(re_pattern, msg_data)
+                lower_raw_tokens = [r.lower() for r in raw_tokens]
+                _, candidate_annotation = lexicon.link_entity(lower_raw_tokens, return_entities=True, agent=agent, uuid=scenario_uuid)
+
+                for c in candidate_annotation:
+                    yield c[1][0], c[0], c[1][1]
+
+def link_transcripts(preprocessor, examples, workers):
+    """
+    Yield (entity, span, type) of entities linked in transcripts (streamed from link_corpus)
+    """
+    for utterances in preprocessor.link_corpus(examples, workers):
+        for utterance in utterances:
+            # Skip empty utterances and other events
+            if utterance:
+                for token in utterance:
+                    if is_entity(token):
+                        span, entity = token
+                        entity, type_ = entity
+                        yield entity, span, type_
+
+def chat_id(chat):
+    """
+    Return the uuid of a chat (or annotated example), or a hash of its content if it has none.
+    """
+    if "uuid" in chat:
+        return chat["uuid"]
+    return hashlib.sha1(json.dumps(chat, sort_keys=True)).hexdigest()
+
+def new_chats(path, store):
+    """
+    Return chats of transcripts not counted in store. Files not modified since the last update are skipped.
+    """
+    if os.path.getmtime(path) <= store["watermark"]:
+        print "Skipping %s: not modified since last update" % path
+        return []
+    chat_ids = set(store["chat_ids"])
+    return [chat for chat in iter_json(path) if chat_id(chat) not in chat_ids]
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser("arguments for basic testing lexicon")
     parser.add_argument("--schema", type=str, help="path to schema to use")
     parser.add_argument("--ranker-data", type=str, help="path to train data")
     parser.add_argument("--annotated-examples-path", help="Json of annotated examples", type=str)
     parser.add_argument("--scenarios-json", help="Json of scenario information", type=str)
-    parser.add_argument("--transcripts", help="Json file of all transcripts collected")
+    parser.add_argument("--transcripts", nargs="+", default=[], help="Json files of transcripts collected")
     parser.add_argument("--output", help="Output path")
+    parser.add_argument("--counts", help="Path to count store to update with new chats only (the TSV is only written if --output is given)")
     add_lexicon_arguments(parser)
 
     args = parser.parse_args()
@@ -38,55 +100,50 @@ if __name__ == "__main__":
     path = args.schema
     schema = Schema(path)
 
-    re_pattern = r"[\w*\']+|[(\w*&)]+|[\w]+|\.|\(|\)|\\|\"|\/|;|\#|\$|\%|\@|\{|\}|\:"
-
-    lexicon = Lexicon(schema, learned_lex=False, entity_ranker=None, scenarios_json=args.scenarios_json, stop_words=args.stop_words)
+    lexicon = Lexicon(schema, learned_lex=False, entity_ranker=None, scenarios_json=args.scenarios_json, stop_words=args.stop_words, cache=args.lexicon_cache)
 
-    with open(args.annotated_examples_path, "r") as f:
-        annotated_examples = json.load(f)
-
-    with open(args.transcripts, "r") as f:
-        examples = json.load(f)
-
-    if not args.output:
-        fout = open("inverse_lexicon_data.txt", "w")
+    if args.counts:
+        store = read_count_store(args.counts)
     else:
+        store = {"counts": {}, "chat_ids": [], "watermark": 0}
+
+    annotated_examples = []
+    if args.annotated_examples_path:
+        with open(args.annotated_examples_path, "r") as f:
+            annotated_examples = json.load(f)
+        chat_ids = set(store["chat_ids"])
+        annotated_examples = [ex for ex in annotated_examples if chat_id(ex) not in chat_ids]
+
+    # Read modification times before the files so that chats dumped meanwhile are not skipped next time
+    watermark = max([store["watermark"]] + [os.path.getmtime(t) for t in args.transcripts])
+    raw_chats = []
+    for transcripts in args.transcripts:
+        raw_chats.extend(new_chats(transcripts, store))
+
+    fout = None
+    if args.output:
         fout = open(args.output, 'w')
-
-    # Process annotated examples
-    for ex in annotated_examples:
-        scenario_uuid = ex["scenario_uuid"]
-
-        for e in ex["events"]:
-            msg_data = e["data"]
-            action = e["action"]
-            agent = e["agent"]
-
-            if action == "message":
-                raw_tokens = re.findall(re_pattern, msg_data)
-                lower_raw_tokens = [r.lower() for r in raw_tokens]
-                _, candidate_annotation = lexicon.link_entity(lower_raw_tokens, return_entities=True, agent=agent, uuid=scenario_uuid)
-
-                for c in candidate_annotation:
-                    # Entity, Span, Type
-                    fout.write(c[1][0] + "\t" + c[0] + "\t" + c[1][1] + "\n")
+    elif not args.counts:
+        fout = open("inverse_lexicon_data.txt", "w")
 
     preprocessor = Preprocessor(schema, lexicon, 'canonical', 'canonical', 'canonical')
-    for raw in examples:
-        ex = Example.from_dict(None, raw)
-        kbs = ex.scenario.kbs
-        mentioned_entities = set()
-        for i, event in enumerate(ex.events):
-            if event.action == 'message':
-                utterance = preprocessor.process_event(event, kbs[event.agent], mentioned_entities)
-                # Skip empty utterances
-                if utterance:
-                    utterance = utterance[0]
-                    for token in utterance:
-                        if is_entity(token):
-                            span, entity = token
-                            entity, type_ = entity
-                            # Entity, Span, Type
-                            fout.write(entity + "\t" + span + "\t" + type_ + "\n")
-
-    fout.close()
+    examples = (Example.from_dict(None, raw) for raw in raw_chats)
+    counts = store["counts"]
+    num_realizations = 0
+    for entity, span, type_ in chain(link_annotated_examples(lexicon, annotated_examples),
+                                     link_transcripts(preprocessor, examples, args.link_workers)):
+        if fout:
+            # Entity, Span, Type
+            fout.write(entity + "\t" + span + "\t" + type_ + "\n")
+        span_counts = counts.setdefault(entity, {})
+        span_counts[span] = span_counts.get(span, 0) + 1
+        num_realizations += 1
+
+    if fout:
+        fout.close()
+
+    if args.counts:
+        store["chat_ids"].extend(chat_id(ex) for ex in chain(annotated_examples, raw_chats))
+        store["watermark"] = watermark
+        write_count_store(store, args.counts)
+    print "Counted %d realizations from %d new chats" % (num_realizations, len(annotated_examples) + len(raw_chats))
@@ -1,11 +1,12 @@
 #!/usr/bin/env python
 
 import argparse
+import json
 import random
 import numpy as np
 from itertools import izip
 import sys
-from src.basic.util import random_multinomial, generate_uuid, write_json
+from src.basic.util import generate_uuid, fork_map
 from src.basic.schema import Schema
 from src.basic.scenario_db import Scenario, ScenarioDB, add_scenario_arguments
 from src.basic.kb import KB
@@ -15,6 +16,7 @@ parser.add_argument('--random-seed', help='Random seed', type=int, default=1)
 parser.add_argument('--num-scenarios', help='Number of scenarios to generate', type=int, default=1)
 parser.add_argument('--num-items', help='Number of items to generate per scenario', type=int, default=10)
 parser.add_argument('--domain', help='{MutualFriends, Matchmaking}', default=None)
+parser.add_argument('--workers', help='Number of processes generating scenarios', type=int, default=1)
 
 
 def add_randomization_arguments(parser):
@@ -37,130 +39,165 @@ def add_randomization_arguments(parser):
 add_scenario_arguments(parser)
 add_randomization_arguments(parser)
 args = parser.parse_args()
-if args.random_seed:
-    random.seed(args.random_seed)
-    np.random.seed(args.random_seed)
 
 
-def get_multinomial(alpha, n):
-    return np.random.dirichlet([alpha] * n)
+def scenario_rngs(index, attempt):
+    '''
+    Random streams (numpy and python) of one attempt at generating the index-th scenario.
+    They only depend on the random seed, index and attempt, so the scenarios generated do not
+    depend on the number of workers and any slice can be regenerated.
+    '''
+    if args.random_seed:
+        rng = np.random.RandomState([args.random_seed, index, attempt])
+    else:
+        rng = np.random.RandomState()
+    return rng, random.Random(rng.randint(2**31))
 
 
-def select_alphas(attributes):
-    alphas = np.random.choice(args.alphas, size=len(attributes))
+def get_multinomial(alpha, n, rng):
+    return rng.dirichlet([alpha] * n)
+
+
+def select_alphas(attributes, rng):
+    alphas = rng.choice(args.alphas, size=len(attributes))
     return dict(zip(attributes, alphas))
 
 
-def generate_scenario(schema):
+def sample_items(distribs, attributes, size, rng):
+    '''
+    Sample |size| items from the agent's value distribution of each attribute.
+    Return a (size, num_attributes) array of value indices and the integer code of each item.
+    '''
+    indices = np.empty((size, len(attributes)), dtype=np.int64)
+    codes = np.zeros(size, dtype=np.int64)
+    for j, attr in enumerate(attributes):
+        cdf = np.cumsum(distribs[attr.name])
+        indices[:, j] = np.minimum(np.searchsorted(cdf, rng.random_sample(size)), len(cdf) - 1)
+        codes = codes * len(cdf) + indices[:, j]
+    return indices, codes
+
+
+def select_items(codes, num_items):
+    '''
+    Select num_items distinct items for each agent such that exactly one item is shared.
+    codes: item codes sampled by each agent, in order
+    Return the selected positions in codes for each agent (the match first), or None if there
+    are not enough items yet.
+    '''
+    firsts = []
+    for agent_codes in codes:
+        _, first = np.unique(agent_codes, return_index=True)
+        firsts.append(np.sort(first))
+    distinct = [agent_codes[first] for agent_codes, first in izip(codes, firsts)]
+    common = np.intersect1d(distinct[0], distinct[1])
+    if len(common) == 0:
+        return None
+
+    # The match is the shared item that both agents sampled the earliest
+    positions = []
+    for agent_codes in distinct:
+        order = np.argsort(agent_codes)
+        positions.append(order[np.searchsorted(agent_codes, common, sorter=order)])
+    match = np.argmin(np.maximum(*positions))
+
+    selected = []
+    for agent, first in enumerate(firsts):
+        # Other shared items are dropped to keep exactly one match
+        others = first[~np.in1d(distinct[agent], common)][:num_items-1]
+        if len(others) < num_items - 1:
+            return None
+        selected.append(np.concatenate(([first[positions[agent][match]]], others)))
+    return selected
+
+
+def generate_scenario(schema, rng, py_rng):
     num_items = args.num_items
     if args.random_items:
-        num_items = np.random.choice(xrange(args.min_items, args.max_items+1))
+        num_items = rng.choice(xrange(args.min_items, args.max_items+1))
     alphas = schema.alphas
     random_attributes = args.random_attributes
     scenario_attributes = schema.attributes
     if random_attributes:
         # sample random number and set of attributes, and choose alphas for each attribute
-        num_attributes = min(np.random.choice(xrange(args.min_attributes, args.max_attributes)), len(schema.attributes))
-        scenario_attributes = np.random.choice(schema.attributes, num_attributes, replace=False)
+        num_attributes = min(rng.choice(xrange(args.min_attributes, args.max_attributes)), len(schema.attributes))
+        scenario_attributes = rng.choice(schema.attributes, num_attributes, replace=False)
         scenario_attributes = schema.get_ordered_attribute_subset(scenario_attributes)
-        alphas = select_alphas(scenario_attributes)
+        alphas = select_alphas(scenario_attributes, rng)
 
     # Generate the profile of the two agents
     agents = (0, 1)
     distribs = ({}, {})
     values = {}  # {attr_name: possible values}
     num_values = num_items * 2
-    for attr, alpha in alphas.iteritems():
+    # NOTE: iterate in attribute order (not over the alphas dict) so that draws are reproducible
+    for attr in scenario_attributes:
         n = min(len(schema.values[attr.value_type]), num_values)
-        values[attr.name] = random.sample(schema.values[attr.value_type], n)
+        values[attr.name] = py_rng.sample(schema.values[attr.value_type], n)
         for agent in agents:
-            distribs[agent][attr.name] = get_multinomial(alpha, n)
-
-    # Generate items for each agent until we get a match
-    agent_item_hashes = ({}, {})
-    agent_items = ([], [])
-    match = None
-    for i in range(100000):
-        if match and len(agent_items[0]) >= num_items and len(agent_items[1]) >= num_items:
-            break
-
+            distribs[agent][attr.name] = get_multinomial(alphas[attr], n, rng)
+
+    # Sample blocks of items for each agent until we get enough distinct items and a match
+    samples = ([], [])
+    block_size = max(4 * num_items, 32)
+    num_samples = 0
+    selected = None
+    while selected is None:
+        if num_samples >= 100000:
+            print >> sys.stderr,  'Failed to match'
+            return None
         for agent in agents:
-            # Create the item (and its hash)
-            item = {}
-            item_hash = []
-            for attr in scenario_attributes:
-                distrib = distribs[agent][attr.name]
-                index = random_multinomial(distrib)
-                # print attr.name, index, len(values[attr.name])
-                value = values[attr.name][index]
-                item[attr.name] = value
-                item_hash.append(index)
-            item_hash = ' '.join(map(str, item_hash))
-
-            # Make sure no duplicated entries
-            if item_hash in agent_item_hashes[agent]:
-                continue
-
-            if item_hash in agent_item_hashes[1 - agent]:
-                # Make sure there's exactly one match
-                if match is not None:
-                    continue
-                match = [None, None]
-                match[agent] = len(agent_items[agent])
-                match[1 - agent] = agent_item_hashes[1 - agent][item_hash]
-
-            # Add the item
-            agent_item_hashes[agent][item_hash] = len(agent_items[agent])
-            agent_items[agent].append(item)
-
-    if not match:
-        print >> sys.stderr,  'Failed to match'
-        return None
-
-    # Move the matching item to the top
-    def swap(l, i, j):
-        t = l[i]
-        l[i] = l[j]
-        l[j] = t
-    for agent in agents:
-        swap(agent_items[agent], 0, match[agent])
-
-    # Truncate to num_items
-    for agent in agents:
-        del agent_items[agent][num_items:]
+            samples[agent].append(sample_items(distribs[agent], scenario_attributes, block_size, rng))
+        num_samples += block_size
+        block_size *= 2
+        indices = [np.concatenate([x[0] for x in samples[agent]]) for agent in agents]
+        codes = [np.concatenate([x[1] for x in samples[agent]]) for agent in agents]
+        selected = select_items(codes, num_items)
 
+    agent_items = ([], [])
     for agent in agents:
-        if len(agent_items[agent]) != num_items:
-            raise Exception('Failed to generate enough items')
+        for row in indices[agent][selected[agent]]:
+            agent_items[agent].append({attr.name: values[attr.name][index] for attr, index in izip(scenario_attributes, row)})
 
     # Shuffle items
     for agent in agents:
-        np.random.shuffle(agent_items[agent])
-
-    # Check that there is at least one match
-    matches = []
-    for i in range(num_items):
-        for j in range(num_items):
-            if agent_items[0][i] == agent_items[1][j]:
-                matches.append((i, j))
-    if len(matches) == 0:
-        raise Exception('Internal error: expected at least one match, but got: %s' % matches)
+        rng.shuffle(agent_items[agent])
 
     # Create the scenario
     kbs = [KB(scenario_attributes, items) for items in agent_items]
-    scenario = Scenario(generate_uuid('S'), scenario_attributes, kbs, [alphas[attr] for attr in scenario_attributes])
+    scenario = Scenario(generate_uuid('S', py_rng), scenario_attributes, kbs, [alphas[attr] for attr in scenario_attributes])
     return scenario
 
-# Generate scenarios
+def generate_indexed_scenario(index):
+    '''
+    Generate the index-th scenario (as a dict), retrying with new random streams until it succeeds.
+    '''
+    attempt = 0
+    while True:
+        scenario = generate_scenario(schema, *scenario_rngs(index, attempt))
+        if scenario is not None:
+            return scenario.to_dict()
+        attempt += 1
+
+# Generate scenarios, streaming them to the output file
+# (as JSON Lines if the path ends with .jsonl, otherwise as a JSON list)
 schema = Schema(args.schema_path, args.domain)
+json_lines = args.scenarios_path.endswith('.jsonl')
 scenario_list = []
-while len(scenario_list) < args.num_scenarios:
-    s = generate_scenario(schema)
-    if s is not None:
-        scenario_list.append(s)
+with open(args.scenarios_path, 'w') as fout:
+    if not json_lines:
+        fout.write('[')
+    for i, raw in enumerate(fork_map(generate_indexed_scenario, xrange(args.num_scenarios), args.workers, chunksize=100)):
+        if json_lines:
+            fout.write(json.dumps(raw, sort_keys=True) + '\n')
+        else:
+            fout.write((',\n' if i > 0 else '') + json.dumps(raw, sort_keys=True))
+        # Keep a sample to output
+        if i < 100:
+            scenario_list.append(Scenario.from_dict(schema, raw))
+    if not json_lines:
+        fout.write(']')
 
 scenario_db = ScenarioDB(scenario_list)
-write_json(scenario_db.to_dict(), args.scenarios_path)
 
 # Output a sample of what we've generated
 for i in range(min(100, len(scenario_db.scenarios_list))):
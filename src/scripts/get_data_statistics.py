@@ -1,7 +1,7 @@
 from argparse import ArgumentParser
 import os
 import json
-from src.basic.util import read_json, write_pickle, read_pickle
+from src.basic.util import read_json, write_pickle, read_pickle, iter_json
 from src.basic.scenario_db import ScenarioDB, add_scenario_arguments
 from src.basic.schema import Schema
 from src.model.preprocess import Preprocessor
@@ -43,7 +43,7 @@ def compute_statistics(args, lexicon, schema, scenario_db, transcripts):
 
     # Speech acts
     preprocessor = Preprocessor(schema, lexicon, 'canonical', 'canonical', 'canonical')
-    strategy_stats = analyze_strategy(transcripts, scenario_db, preprocessor, args.text_output, lm)
+    strategy_stats = analyze_strategy(transcripts, scenario_db, preprocessor, args.text_output, lm, args.link_workers)
     print_strategy_stats(strategy_stats)
     stats["speech_act"] = {k[0]: v for k, v in strategy_stats['speech_act'].iteritems() if len(k) == 1}
     stats["kb_strategy"] = strategy_stats['kb_strategy']
@@ -70,8 +70,8 @@ if __name__ == "__main__":
 
     parsed_args = parser.parse_args()
     schema = Schema(parsed_args.schema_path)
-    scenario_db = ScenarioDB.from_dict(schema, read_json(parsed_args.scenarios_path))
-    transcripts = json.load(open(parsed_args.transcripts, 'r'))
+    scenario_db = ScenarioDB.from_dict(schema, iter_json(parsed_args.scenarios_path))
+    transcripts = read_json(parsed_args.transcripts)
     # transcripts = transcripts[:100]
     lexicon = Lexicon(schema, False, scenarios_json=parsed_args.scenarios_path, stop_words=parsed_args.stop_words)
     compute_statistics(parsed_args, lexicon, schema, scenario_db, transcripts)
@@ -4,7 +4,7 @@ matplotlib.use('Agg')
 #matplotlib.rcParams.update({k: font_size for k in ('font.size', 'axes.labelsize', 'xtick.labelsize', 'ytick.labelsize', 'legend.fontsize')})
 import matplotlib.pyplot as plt
 from argparse import ArgumentParser
-from src.basic.util import read_json, write_json
+from src.basic.util import read_json, write_json, iter_json
 from src.scripts.visualize_data import *
 from dataset_statistics import *
 from src.model.preprocess import Preprocessor
@@ -94,10 +94,10 @@ def get_total(scores):
     scores = [x[2] for x in scores]
     return sum([len(x) for x in scores])
 
-def get_stats(chat, agent_id, preprocessor):
-    ex = Example.from_dict(None, chat)
-    kbs = ex.scenario.kbs
-    mentioned_entities = set()
+def get_stats(ex, agent_id, utterances):
+    '''
+    utterances: linked messages of agent_id in ex (see Preprocessor.link_corpus)
+    '''
     stats = {}
     vocab = set()
     for i, event in enumerate(ex.events):
@@ -107,16 +107,14 @@ def get_stats(chat, agent_id, preprocessor):
             utterance = []
             logstats.update_summary_map(stats, {'num_select': 1})
         elif event.action == 'message':
-            utterance = preprocessor.process_event(event, kbs[event.agent], mentioned_entities)
+            utterance = utterances[i]
             # Skip empty utterances
             if not utterance:
                 continue
             else:
-                utterance = utterance[0]
                 for token in utterance:
                     if is_entity(token):
                         logstats.update_summary_map(stats, {'num_entity': 1})
-                        mentioned_entities.add(token[1][0])
                     else:
                         vocab.add(token)
                 logstats.update_summary_map(stats, {'utterance_len': len(utterance)})
@@ -147,16 +145,32 @@ def scatter_plot(question, stat_name, agents, counts, scores):
     plt.tight_layout()
     plt.savefig('%s_%s.png' % (question, stat_name))
 
-def analyze(question_scores, uuid_to_chat, preprocessor):
+def get_all_stats(question_scores, uuid_to_chat, preprocessor, workers=1):
+    '''
+    Return stats of each rated (dialogue_id, agent_id); each chat is linked once per agent.
+    '''
+    chats = defaultdict(set)
+    for question, agent_scores in question_scores.iteritems():
+        for agent, scores in agent_scores.iteritems():
+            for dialogue_id, agent_id, response in scores:
+                chats[int(agent_id)].add(dialogue_id)
+    all_stats = {}
+    for agent_id, dialogue_ids in chats.iteritems():
+        examples = [Example.from_dict(None, uuid_to_chat[dialogue_id]) for dialogue_id in sorted(dialogue_ids)]
+        for ex, utterances in izip(examples, preprocessor.link_corpus(examples, workers, agent=agent_id)):
+            all_stats[(ex.ex_id, agent_id)] = get_stats(ex, agent_id, utterances)
+    return all_stats
+
+def analyze(question_scores, uuid_to_chat, preprocessor, workers=1):
     # factor -> question -> (agent_type, scores)
     examples = defaultdict(lambda : defaultdict(list))
+    all_stats = get_all_stats(question_scores, uuid_to_chat, preprocessor, workers)
     for question, agent_scores in question_scores.iteritems():
         if question == 'comments' or question.endswith('text'):
             continue
         for agent, scores in agent_scores.iteritems():
             for dialogue_id, agent_id, response in scores:
-                chat = uuid_to_chat[dialogue_id]
-                counts = get_stats(chat, int(agent_id), preprocessor)
+                counts = all_stats[(dialogue_id, int(agent_id))]
                 for k, v in counts.iteritems():
                     examples[k][question].extend([(agent, v, np.mean(response))])
     # plot
@@ -316,7 +330,7 @@ if __name__ == '__main__':
     raw_chats = read_json(args.dialogue_transcripts)
     uuid_to_chat = {chat['uuid']: chat for chat in raw_chats}
     schema = Schema(args.schema_path)
-    scenario_db = ScenarioDB.from_dict(schema, read_json(args.scenarios_path))
+    scenario_db = ScenarioDB.from_dict(schema, iter_json(args.scenarios_path))
     dialogue_ids = filter(raw_eval, uuid_to_chat)
 
     for eval_ in raw_eval:
@@ -333,7 +347,7 @@ if __name__ == '__main__':
         schema = Schema(args.schema_path)
         lexicon = Lexicon(schema, False, scenarios_json=args.scenarios_path, stop_words=args.stop_words)
         preprocessor = Preprocessor(schema, lexicon, 'canonical', 'canonical', 'canonical')
-        analyze(question_scores, uuid_to_chat, preprocessor)
+        analyze(question_scores, uuid_to_chat, preprocessor, args.link_workers)
 
     # Visualize
     if args.html_output:
@@ -9,7 +9,7 @@ from src.basic.kb import KB
 from argparse import ArgumentParser
 from src.basic.scenario_db import add_scenario_arguments, ScenarioDB
 from src.basic.schema import Schema
-from src.basic.util import read_json
+from src.basic.util import iter_json
 from datetime import datetime
 
 date_fmt = '%Y-%m-%d %H-%M-%S'
@@ -135,7 +135,7 @@ if __name__ == "__main__":
     parser.add_argument('--surveys', type=str, help='If provided, writes a file containing results from user surveys.')
     args = parser.parse_args()
     schema = Schema(args.schema_path, args.domain)
-    scenario_db = ScenarioDB.from_dict(schema, read_json(args.scenarios_path))
+    scenario_db = ScenarioDB.from_dict(schema, iter_json(args.scenarios_path))
 
     log_transcripts_to_json(scenario_db, args.db, args.output, args.uid)
     if args.surveys:
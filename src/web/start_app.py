@@ -10,10 +10,9 @@ import atexit
 from signal import signal, SIGTERM
 import sys
 
-from src.basic.scenario_db import add_scenario_arguments, ScenarioDB
+from src.basic.scenario_db import add_scenario_arguments, LazyScenarioDB
 from src.basic.schema import Schema
 from src.web.dump_events_to_json import log_transcripts_to_json
-from src.basic.util import read_json
 from src.web import create_app
 from src.basic.systems.simple_system import SimpleSystem
 from src.basic.systems.neural_system import NeuralSystem
@@ -44,6 +43,8 @@ def add_website_arguments(parser):
                              'If the provided directory exists, all data in it is overwritten.')
     parser.add_argument('--domain', type=str,
                         choices=['MutualFriends', 'Matchmaking'])
+    parser.add_argument('--scenario-cache-size', type=int, default=1000,
+                        help='Number of scenarios kept in memory (scenarios are loaded from the scenarios file when used)')
 
 
 def init_database(db_file):
@@ -77,8 +78,7 @@ def init_database(db_file):
 def add_scenarios_to_db(db_file, scenario_db, systems):
     conn = sqlite3.connect(db_file)
     c = conn.cursor()
-    for scenario in scenario_db.scenarios_list:
-        sid = scenario.uuid
+    for sid in scenario_db.uuids:
         for agent_type in systems.keys():
             c.execute('''INSERT INTO scenario VALUES (?,?, 0, 0)''', (sid, agent_type))
 
@@ -215,12 +215,12 @@ if __name__ == "__main__":
 
     schema = Schema(schema_path, domain=args.domain)
     # todo in the future would we want individual models to have different lexicons?
-    lexicon = Lexicon(schema, args.learned_lex, stop_words=args.stop_words)
+    lexicon = Lexicon(schema, args.learned_lex, stop_words=args.stop_words, cache=args.lexicon_cache, link_cache_size=args.link_cache_size)
     if args.inverse_lexicon:
         realizer = InverseLexicon(schema, args.inverse_lexicon)
     else:
         realizer = None
-    scenario_db = ScenarioDB.from_dict(schema, read_json(args.scenarios_path))
+    scenario_db = LazyScenarioDB(schema, args.scenarios_path, args.scenario_cache_size)
     app.config['scenario_db'] = scenario_db
 
     if 'models' not in params.keys():